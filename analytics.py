@@ -0,0 +1,253 @@
+# --- АНАЛИТИКА ИСТОРИИ ---
+
+# Недельные и месячные отчёты по всей истории: скользящие средние, серии дней
+# выше порога, дни недели, частота действий и связки провалов
+# ("скролл" накануне "позднего отбоя").
+#
+# История загружается один раз, одним проходом по каждой таблице, в плотные колонки по дням:
+# array('d') со счётом и array('i') с числом нажатий каждого действия,
+# индекс — номер дня от первого дня истории. Дальше всё считается срезами
+# массивов и префиксными суммами, без запросов по дням. Присутствие провалов
+# по дням хранится битовыми масками (int), поэтому совместная встречаемость
+# любой пары провалов за всю историю — одно & и bit_count().
+
+from array import array
+from datetime import date, timedelta
+
+# Порог дня для серий: счёт не ниже — день засчитан.
+STREAK_THRESHOLD = 70
+# Окна скользящих средних, в днях.
+ROLLING_WINDOWS = (7, 30)
+# Минимум совместных дней и подъём вероятности, чтобы связка провалов попала в отчёт.
+CORRELATION_MIN_DAYS = 3
+CORRELATION_MIN_LIFT = 1.3
+PERIODS = {"week": 7, "month": 30}
+WEEKDAYS = ("пн", "вт", "ср", "чт", "пт", "сб", "вс")
+
+
+class History:
+    """Вся история в колонках по дням: индекс — номер дня от start."""
+
+    def __init__(self, start: date, days: int):
+        self.start = start
+        self.days = days
+        self.scores = array("d", [0.0]) * days
+        # Действие -> чистые нажатия по дням (отмены вычтены).
+        self.actions = {}
+        # Провал -> число по дням и битовая маска дней, когда он был.
+        self.failures = {}
+        self.failure_masks = {}
+
+    def day(self, index: int) -> date:
+        return self.start + timedelta(days=index)
+
+    def column(self, table: dict, name: str, typecode: str = "i") -> array:
+        series = table.get(name)
+        if series is None:
+            series = table[name] = array(typecode, [0]) * self.days
+        return series
+
+
+def load_history(conn, today: date = None) -> History:
+    """
+    Загружает счёт и журнал действий (сырые строки и дневные агрегаты архива)
+    одним проходом по каждой таблице и раскладывает по колонкам.
+    История тянется до today включительно.
+    """
+    c = conn.cursor()
+    c.execute("SELECT MIN(first) FROM (SELECT MIN(date) AS first FROM scores "
+              "UNION ALL SELECT MIN(substr(timestamp, 1, 10)) FROM actions_log "
+              "UNION ALL SELECT MIN(date) FROM actions_daily)")
+    first = c.fetchone()[0]
+    today = today or date.today()
+    start = min(date.fromisoformat(first), today) if first else today
+    history = History(start, (today - start).days + 1)
+    base = start.toordinal()
+    indexes = {}
+
+    def day_index(day: str) -> int:
+        index = indexes.get(day)
+        if index is None:
+            index = indexes[day] = date.fromisoformat(day).toordinal() - base
+        return index
+
+    c.execute("SELECT date, score FROM scores")
+    for day, score in c.fetchall():
+        index = day_index(day)
+        if 0 <= index < history.days:
+            history.scores[index] = score or 0.0
+
+    # Сырой журнал читается без GROUP BY: сортировка для группировки в SQLite
+    # дороже, чем сложить строки здесь — в день обычно по одному нажатию на действие.
+    # Отмены копятся отдельно и вычитаются в конце: строка отмены может прийти
+    # раньше отменённой (агрегаты архива идут в своём порядке).
+    undos = {}
+    c.execute("SELECT substr(timestamp, 1, 10), action, type, 1 FROM actions_log "
+              "UNION ALL SELECT date, action, type, count FROM actions_daily")
+    for day, action, action_type, count in c.fetchall():
+        index = day_index(day)
+        if not 0 <= index < history.days:
+            continue
+        if action_type == "отмена":
+            history.column(undos, action)[index] += count
+        elif action_type == "провал":
+            history.column(history.failures, action)[index] += count
+        else:
+            history.column(history.actions, action)[index] += count
+
+    # Отмена гасит то, что отменяет, — провал или действие, как в дневной сводке;
+    # в минус столбец не уходит, а полностью отменённое исчезает из отчёта.
+    for action, cancelled in undos.items():
+        table = history.failures if action in history.failures else history.actions
+        series = table.get(action)
+        if series is None:
+            continue
+        for index, count in enumerate(cancelled):
+            if count:
+                series[index] = max(0, series[index] - count)
+        if not any(series):
+            del table[action]
+
+    for action, series in history.failures.items():
+        mask = 0
+        for index, count in enumerate(series):
+            if count:
+                mask |= 1 << index
+        history.failure_masks[action] = mask
+    return history
+
+
+def rolling_mean(values: array, window: int) -> array:
+    """Скользящее среднее по префиксным суммам; первые window-1 дней — среднее по доступным."""
+    prefix = array("d", [0.0]) * (len(values) + 1)
+    total = 0.0
+    for i, value in enumerate(values):
+        total += value
+        prefix[i + 1] = total
+    return array("d", ((prefix[i + 1] - prefix[max(0, i + 1 - window)]) / min(window, i + 1)
+                       for i in range(len(values))))
+
+
+def streaks(values: array, threshold: float):
+    """Текущая и самая длинная серия дней со значением не ниже порога; и день конца лучшей серии."""
+    current = longest = longest_end = 0
+    for i, value in enumerate(values):
+        current = current + 1 if value >= threshold else 0
+        if current > longest:
+            longest, longest_end = current, i
+    return current, longest, longest_end
+
+
+def weekday_means(history: History) -> list:
+    """Средний счёт по дням недели (пн..вс) за всю историю; None — такого дня в истории ещё не было."""
+    means = []
+    for weekday in range(7):
+        column = history.scores[(weekday - history.start.weekday()) % 7::7]
+        means.append(sum(column) / len(column) if column else None)
+    return means
+
+
+def action_frequency(history: History, table: dict, period: int) -> list:
+    """(действие, раз за период, активных дней, раз за прошлый период), по убыванию частоты."""
+    rows = []
+    for name, series in table.items():
+        recent = series[-period:]
+        previous = series[-2 * period:-period] if history.days > period else array("i")
+        count = sum(recent)
+        if count > 0 or sum(previous) > 0:
+            rows.append((name, count, len(recent) - recent.count(0), sum(previous)))
+    rows.sort(key=lambda row: (-row[1], row[0]))
+    return rows
+
+
+def failure_correlations(history: History) -> list:
+    """
+    Связки провалов за всю историю: (A, B, сдвиг, совместных дней, подъём).
+    Сдвиг 0 — в один день, 1 — B на следующий день после A.
+    Подъём = P(B | A) / P(B); в отчёт попадают достаточно частые и заметные связки.
+    """
+    masks = history.failure_masks
+    days = history.days
+    found = []
+    for a, mask_a in masks.items():
+        days_a = mask_a.bit_count()
+        for b, mask_b in masks.items():
+            base_rate = mask_b.bit_count() / days
+            for shift in (0, 1):
+                if a == b or (shift == 0 and a > b):
+                    continue
+                together = ((mask_a << shift) & mask_b).bit_count()
+                if together < CORRELATION_MIN_DAYS or not base_rate:
+                    continue
+                lift = together / days_a / base_rate
+                if lift >= CORRELATION_MIN_LIFT:
+                    found.append((a, b, shift, together, round(lift, 2)))
+    found.sort(key=lambda row: (-row[4], -row[3]))
+    return found
+
+
+def _mean(values) -> float:
+    return sum(values) / len(values) if len(values) else 0.0
+
+
+def build_report(history: History, period: int = 7, threshold: float = STREAK_THRESHOLD) -> dict:
+    """Сводка за последние period дней на фоне всей истории."""
+    scores = history.scores
+    recent = scores[-period:]
+    previous = scores[-2 * period:-period] if history.days > period else array("d")
+    rolling = {window: rolling_mean(scores, window) for window in ROLLING_WINDOWS}
+    best_week = max(range(history.days), key=lambda i: rolling[7][i])
+    current, longest, longest_end = streaks(scores, threshold)
+    weekdays = weekday_means(history)
+
+    return {
+        "period": period,
+        # Дней периода, которые покрывает история: меньше period, пока история короче.
+        "covered": len(recent),
+        "from": history.day(max(0, history.days - period)).isoformat(),
+        "to": history.day(history.days - 1).isoformat(),
+        "history_days": history.days,
+        "avg": round(_mean(recent), 1),
+        "prev_avg": round(_mean(previous), 1) if len(previous) else None,
+        "days_above": sum(1 for value in recent if value >= threshold),
+        "rolling": {window: round(values[-1], 1) for window, values in rolling.items()},
+        "best_week": (round(rolling[7][best_week], 1), history.day(best_week).isoformat()),
+        "threshold": threshold,
+        "streak": current,
+        "longest_streak": (longest, history.day(longest_end - longest + 1).isoformat() if longest else None),
+        "weekdays": [round(value, 1) if value is not None else None for value in weekdays],
+        "actions": action_frequency(history, history.actions, period)[:10],
+        "failures": action_frequency(history, history.failures, period)[:5],
+        "correlations": failure_correlations(history)[:5],
+    }
+
+
+def format_report(report: dict) -> str:
+    """Отчёт текстом: идёт и в чат, и в промпт ИИ вместо сырых строк журнала."""
+    lines = [f"Период: {report['from']} — {report['to']} ({report['period']} дн., история {report['history_days']} дн.)"]
+    trend = ""
+    if report["prev_avg"] is not None:
+        trend = f" (прошлый период {report['prev_avg']})"
+    lines.append(f"Средний счёт: {report['avg']}{trend}; дней ≥{report['threshold']:g}: "
+                 f"{report['days_above']} из {report['covered']}")
+    rolling = ", ".join(f"{window} дн. {value}" for window, value in report["rolling"].items())
+    lines.append(f"Скользящее среднее: {rolling}; лучшая неделя: {report['best_week'][0]} "
+                 f"(до {report['best_week'][1]})")
+    longest, since = report["longest_streak"]
+    lines.append(f"Серия дней ≥{report['threshold']:g}: сейчас {report['streak']}, рекорд {longest}"
+                 + (f" (с {since})" if since else ""))
+    weekdays = report["weekdays"]
+    seen = [i for i in range(7) if weekdays[i] is not None]
+    best, worst = max(seen, key=weekdays.__getitem__), min(seen, key=weekdays.__getitem__)
+    lines.append("Дни недели: " + ", ".join(f"{WEEKDAYS[i]} {weekdays[i]}" for i in seen)
+                 + f" — сильнее всего {WEEKDAYS[best]}, слабее всего {WEEKDAYS[worst]}")
+    if report["actions"]:
+        lines.append("Действия (раз / дней, прошлый период): " + ", ".join(
+            f"{name} {count}/{active} ({previous})" for name, count, active, previous in report["actions"]))
+    if report["failures"]:
+        lines.append("Срывы (раз / дней, прошлый период): " + ", ".join(
+            f"{name} {count}/{active} ({previous})" for name, count, active, previous in report["failures"]))
+    for a, b, shift, together, lift in report["correlations"]:
+        when = "на следующий день" if shift else "в тот же день"
+        lines.append(f"Связка: после «{a}» «{b}» {when} в {lift}× чаще обычного ({together} дн.)")
+    return "\n".join(lines)
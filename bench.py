@@ -0,0 +1,448 @@
+# --- БЕНЧМАРК БОТА БЕЗ СЕТИ ---
+
+# Этот скрипт гоняет message_handler и callback_handler через настоящий Dispatcher,
+# но вместо Telegram, OpenRouter и Google подставляет локальные заглушки
+# с настраиваемой задержкой и долей ошибок. Результат — пропускная способность
+# и p50/p95/p99 по каждому маршруту на разных уровнях параллельности,
+# плюс JSON, который можно сравнить с прогоном на другом коммите.
+#
+# Пример:
+#   python bench.py --concurrency 1,8,32 --requests 200 --llm-latency 0.8 --output bench_results.json
+#   python bench.py --compare bench_results.json
+#   python bench.py --startup 20
+#   python bench.py --late-failure
+
+import argparse
+import asyncio
+import base64
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from aiohttp import web
+
+BENCH_TOKEN = "123456:BENCH-TOKEN"
+BENCH_CHAT_ID = 1
+
+# Прозрачный PNG 1x1 — ответ заглушки Imagen.
+STUB_PNG = "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=="
+# Полсекунды тишины 16-бит PCM 24 кГц — ответ заглушки TTS.
+STUB_PCM = base64.b64encode(b"\x00\x00" * 12000).decode()
+
+# Маршрут -> (тип апдейта, текст сообщения или callback_data).
+ROUTES = {
+    "/start": ("message", "/start"),
+    "/stats": ("message", "/stats"),
+    "/silly_score": ("message", "/silly_score"),
+    "/картинка": ("message", "/картинка воин, идущий к своей цели"),
+    "/chart": ("message", "/chart 365"),
+    "план:": ("message", "План: кодинг, тренировка, чтение"),
+    "chat": ("message", "Как не сорваться вечером?"),
+    "main_menu": ("callback", "main_menu"),
+    "add_*": ("callback", "add_чтение"),
+    "fail_*": ("callback", "fail_скролл"),
+    "undo_*": ("callback", "undo_чтение"),
+    "progress": ("callback", "progress"),
+    "analyze_day": ("callback", "analyze_day"),
+    "show_plan": ("callback", "show_plan"),
+    "show_stats": ("callback", "show_stats"),
+}
+
+
+# --- ЗАГЛУШКИ ВНЕШНИХ СЕРВИСОВ ---
+
+class StubProfile:
+    """Распределение задержки (логнормальное вокруг медианы) и доля ошибок одной заглушки."""
+
+    def __init__(self, median: float, errors: float, sigma: float):
+        self.median = median
+        self.errors = errors
+        self.sigma = sigma
+        self.calls = 0
+        self.failed = 0
+
+    async def apply(self):
+        """Выдерживает задержку и решает, должен ли этот вызов упасть."""
+        self.calls += 1
+        if self.median > 0:
+            await asyncio.sleep(random.lognormvariate(math.log(self.median), self.sigma))
+        if random.random() < self.errors:
+            self.failed += 1
+            raise web.HTTPInternalServerError(text="stub failure")
+
+
+def build_stub_app(profiles: dict, outbox: list = None) -> web.Application:
+    """
+    Собирает одно aiohttp-приложение с заглушками Bot API, OpenRouter, Imagen и TTS.
+    В outbox, если он передан, складываются пары (метод Bot API, текст сообщения).
+    """
+    message_ids = itertools.count(1000)
+
+    async def telegram(request):
+        form = await request.post()
+        await profiles["telegram"].apply()
+        method = request.match_info["method"]
+        if outbox is not None:
+            outbox.append((method, form.get("text")))
+        if method == "answerCallbackQuery":
+            return web.json_response({"ok": True, "result": True})
+        message = {
+            "message_id": next(message_ids),
+            "date": int(time.time()),
+            "chat": {"id": BENCH_CHAT_ID, "type": "private"},
+            "text": "",
+        }
+        if method in ("sendPhoto", "editMessageMedia"):
+            # Как настоящий Bot API: загруженное фото возвращается с file_id для повторной отправки.
+            message["photo"] = [{"file_id": f"stub-photo-{message['message_id']}", "file_unique_id": "stub",
+                                 "width": 900, "height": 420}]
+        return web.json_response({"ok": True, "result": message})
+
+    async def chat_completions(request):
+        await request.read()
+        await profiles["llm"].apply()
+        return web.json_response({
+            "id": "bench", "object": "chat.completion", "created": int(time.time()), "model": "bench",
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": "Артем, работай. Deep Work ждёт."}}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        })
+
+    async def google(request):
+        await request.read()
+        if request.match_info["call"].endswith(":predict"):
+            await profiles["imagen"].apply()
+            return web.json_response({"predictions": [{"bytesBase64Encoded": STUB_PNG}]})
+        await profiles["tts"].apply()
+        return web.json_response({"candidates": [{"content": {"parts": [{"inlineData": {
+            "mimeType": "audio/L16;codec=pcm;rate=24000", "data": STUB_PCM}}]}}]})
+
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app.router.add_post("/bot{token}/{method}", telegram)
+    app.router.add_post("/api/v1/chat/completions", chat_completions)
+    app.router.add_post("/v1beta/models/{call}", google)
+    return app
+
+
+def start_stubs(profiles: dict, outbox: list = None):
+    """
+    Поднимает заглушки на свободном локальном порту в отдельном потоке со своим циклом,
+    как настоящий удалённый сервер: синхронные вызовы бота не должны их блокировать.
+    Возвращает (stop, base_url).
+    """
+    loop = asyncio.new_event_loop()
+    ready = threading.Event()
+    state = {}
+
+    def serve():
+        asyncio.set_event_loop(loop)
+        runner = web.AppRunner(build_stub_app(profiles, outbox), access_log=None)
+        loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        loop.run_until_complete(site.start())
+        state["url"] = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+        ready.set()
+        loop.run_forever()
+        loop.run_until_complete(runner.cleanup())
+        loop.close()
+
+    thread = threading.Thread(target=serve, name="bench-stubs", daemon=True)
+    thread.start()
+    ready.wait()
+
+    def stop():
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+
+    return stop, state["url"]
+
+
+# --- ПРОГОН ---
+
+def import_bot(base_url: str, db_path: str):
+    """Импортирует main.py, направив его во все заглушки и во временную базу."""
+    os.environ.update({
+        "BOT_TOKEN": BENCH_TOKEN,
+        "CHAT_ID": str(BENCH_CHAT_ID),
+        "OPENROUTER_API_KEY": "bench",
+        "GOOGLE_AI_API_KEY": "bench",
+        "TELEGRAM_API_URL": base_url,
+        "OPENROUTER_BASE_URL": f"{base_url}/api/v1",
+        "GOOGLE_AI_BASE_URL": base_url,
+        "BOT_DB_PATH": db_path,
+        "IMAGE_CACHE_DIR": os.path.join(os.path.dirname(db_path), "image_cache"),
+    })
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main
+    main.create_app()
+    main.init_db()
+    return main
+
+
+def make_update(main, update_id: int, kind: str, payload: str):
+    """Строит апдейт Telegram от имени владельца бота."""
+    user = {"id": BENCH_CHAT_ID, "is_bot": False, "first_name": "Артем"}
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": BENCH_CHAT_ID, "type": "private"},
+        "from": user,
+        "text": payload,
+    }
+    if kind == "message":
+        data = {"update_id": update_id, "message": message}
+    else:
+        data = {"update_id": update_id, "callback_query": {
+            "id": str(update_id), "from": user, "chat_instance": "bench", "data": payload, "message": message}}
+    return main.types.Update.model_validate(data, context={"bot": main.bot})
+
+
+def percentile(sorted_values: list, q: float) -> float:
+    """Перцентиль по методу ближайшего ранга."""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, math.ceil(q / 100 * len(sorted_values)) - 1)
+    return sorted_values[rank]
+
+
+async def measure_route(main, route: str, concurrency: int, total: int, update_ids) -> dict:
+    """Прогоняет total апдейтов одного маршрута с заданной параллельностью."""
+    kind, payload = ROUTES[route]
+    latencies = []
+    errors = 0
+    remaining = iter(range(total))
+
+    async def worker():
+        nonlocal errors
+        for _ in remaining:
+            update = make_update(main, next(update_ids), kind, payload)
+            started = time.perf_counter()
+            try:
+                await main.dp.feed_update(main.bot, update)
+            except Exception as e:
+                errors += 1
+                logging.debug("%s: %s", route, e)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    # Поздние ответы ИИ не должны попадать в замер следующего маршрута.
+    if main._background_tasks:
+        await asyncio.gather(*list(main._background_tasks), return_exceptions=True)
+
+    latencies.sort()
+    return {
+        "route": route,
+        "concurrency": concurrency,
+        "requests": total,
+        "errors": errors,
+        "throughput_rps": round(total / elapsed, 2) if elapsed else 0.0,
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 2) if latencies else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+    }
+
+
+# --- ПОЗДНИЙ ОТВЕТ ИИ, КОТОРЫЙ НЕ ПРИШЁЛ ---
+
+# Сообщение и правка, которую бот должна (или не должна) сделать, если ИИ
+# не уложился в бюджет, а потом упал: шаблон "chat" обещает ответ и заменяется
+# сообщением об ошибке, шаблон "pmo" — самостоятельный ответ и остаётся как есть.
+LATE_FAILURE_CASES = (
+    ("pmo", "Опять ломка, боюсь сорваться", False),
+    ("chat", "Как не сорваться вечером?", True),
+)
+
+
+async def check_late_failure(main, outbox: list, update_ids) -> list:
+    """Прогоняет LATE_FAILURE_CASES при падающем медленном ИИ. Возвращает расхождения."""
+    mismatches = []
+    for route, text, expect_failure_edit in LATE_FAILURE_CASES:
+        main.AI_LATENCY_BUDGETS[route] = 0.05
+        outbox.clear()
+        await main.dp.feed_update(main.bot, make_update(main, next(update_ids), "message", text))
+        if main._background_tasks:
+            await asyncio.gather(*list(main._background_tasks), return_exceptions=True)
+        edits = [edited for method, edited in outbox if method == "editMessageText"]
+        expected = [main.AI_LATE_FAILURE_RESPONSE] if expect_failure_edit else []
+        if edits != expected:
+            mismatches.append(f"{route}: ожидались правки {expected}, пришли {edits}")
+    return mismatches
+
+
+def git_commit() -> str:
+    """Текущий коммит, чтобы результаты можно было сопоставить с кодом."""
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return "unknown"
+
+
+def print_results(results: list):
+    """Печатает таблицу результатов."""
+    print(f"{'маршрут':<14} {'conc':>5} {'rps':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'ошибки':>7}")
+    for r in results:
+        print(f"{r['route']:<14} {r['concurrency']:>5} {r['throughput_rps']:>9} {r['p50_ms']:>9} "
+              f"{r['p95_ms']:>9} {r['p99_ms']:>9} {r['errors']:>7}")
+
+
+def print_comparison(baseline: dict, results: list):
+    """Сравнивает прогон с сохранённым JSON другого коммита."""
+    previous = {(r["route"], r["concurrency"]): r for r in baseline.get("results", [])}
+    print(f"\nСравнение с {baseline.get('commit', '?')}:")
+    print(f"{'маршрут':<14} {'conc':>5} {'Δ rps':>9} {'Δ p95':>9} {'Δ p99':>9}")
+    for r in results:
+        old = previous.get((r["route"], r["concurrency"]))
+        if not old:
+            continue
+
+        def delta(key):
+            return f"{(r[key] - old[key]) / old[key] * 100:+.1f}%" if old[key] else "n/a"
+
+        print(f"{r['route']:<14} {r['concurrency']:>5} {delta('throughput_rps'):>9} "
+              f"{delta('p95_ms'):>9} {delta('p99_ms'):>9}")
+
+
+# --- ХОЛОДНЫЙ СТАРТ ---
+
+# Тяжёлые модули, которые должны грузиться только по требованию.
+HEAVY_MODULES = ("openai", "requests", "httpx", "pydub", "PIL")
+
+# Выполняется в свежем интерпретаторе: время import main и create_app
+# и список тяжёлых модулей, подгруженных к этому моменту.
+STARTUP_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+main.create_app()
+created = time.perf_counter()
+print(json.dumps({
+    "import_ms": (imported - started) * 1000,
+    "create_app_ms": (created - imported) * 1000,
+    "heavy_loaded": [name for name in %r if name in sys.modules],
+}))
+""" % (HEAVY_MODULES,)
+
+
+def measure_startup(runs: int) -> dict:
+    """Замеряет холодный старт main.py в runs свежих процессах."""
+    env = dict(os.environ, BOT_TOKEN=BENCH_TOKEN, CHAT_ID=str(BENCH_CHAT_ID),
+               OPENROUTER_API_KEY="bench", GOOGLE_AI_API_KEY="bench")
+    samples = []
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, "-c", STARTUP_PROBE], env=env, text=True,
+                                         cwd=os.path.dirname(os.path.abspath(__file__)))
+        samples.append(json.loads(output.strip().splitlines()[-1]))
+
+    summary = {"runs": runs, "heavy_loaded": sorted({name for s in samples for name in s["heavy_loaded"]})}
+    for key in ("import_ms", "create_app_ms"):
+        values = sorted(s[key] for s in samples)
+        summary[f"{key}_p50"] = round(percentile(values, 50), 1)
+        summary[f"{key}_max"] = round(values[-1], 1)
+    return summary
+
+
+def print_startup(summary: dict):
+    """Печатает результат замера холодного старта."""
+    print(f"Холодный старт, {summary['runs']} запусков:")
+    print(f"  import main:  p50 {summary['import_ms_p50']} мс, max {summary['import_ms_max']} мс")
+    print(f"  create_app(): p50 {summary['create_app_ms_p50']} мс, max {summary['create_app_ms_max']} мс")
+    print(f"  тяжёлые модули после старта: {', '.join(summary['heavy_loaded']) or 'нет'}")
+
+
+async def run(args) -> dict:
+    profiles = {
+        "telegram": StubProfile(args.telegram_latency, args.telegram_errors, args.jitter),
+        "llm": StubProfile(args.llm_latency, args.llm_errors, args.jitter),
+        "imagen": StubProfile(args.imagen_latency, args.imagen_errors, args.jitter),
+        "tts": StubProfile(args.tts_latency, args.tts_errors, args.jitter),
+    }
+    outbox = []
+    stop_stubs, base_url = start_stubs(profiles, outbox)
+    db_dir = tempfile.mkdtemp(prefix="bvot-bench-")
+    try:
+        main = import_bot(base_url, os.path.join(db_dir, "bench.db"))
+        update_ids = itertools.count(1)
+        if args.late_failure:
+            mismatches = await check_late_failure(main, outbox, update_ids)
+            await main.bot.session.close()
+            return {"commit": git_commit(), "late_failure": mismatches}
+        routes = args.routes.split(",") if args.routes else list(ROUTES)
+        results = []
+        for concurrency in [int(level) for level in args.concurrency.split(",")]:
+            for route in routes:
+                results.append(await measure_route(main, route, concurrency, args.requests, update_ids))
+        await main.bot.session.close()
+    finally:
+        stop_stubs()
+
+    return {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": vars(args),
+        "stub_calls": {name: {"calls": p.calls, "failed": p.failed} for name, p in profiles.items()},
+        "results": results,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк обработчиков бота.")
+    parser.add_argument("--concurrency", default="1,8,32", help="уровни параллельности через запятую")
+    parser.add_argument("--requests", type=int, default=100, help="апдейтов на маршрут и уровень")
+    parser.add_argument("--routes", default="", help=f"маршруты через запятую (по умолчанию все: {', '.join(ROUTES)})")
+    parser.add_argument("--jitter", type=float, default=0.3, help="sigma логнормальной задержки заглушек")
+    for name, latency in (("telegram", 0.02), ("llm", 0.5), ("imagen", 1.0), ("tts", 0.3)):
+        parser.add_argument(f"--{name}-latency", type=float, default=latency, help=f"медианная задержка {name}, с")
+        parser.add_argument(f"--{name}-errors", type=float, default=0.0, help=f"доля ошибок {name} (0..1)")
+    parser.add_argument("--output", default="", help="куда записать JSON с результатами")
+    parser.add_argument("--compare", default="", help="JSON предыдущего прогона для сравнения")
+    parser.add_argument("--seed", type=int, default=0, help="seed генератора задержек")
+    parser.add_argument("--startup", type=int, default=0,
+                        help="вместо прогона маршрутов замерить холодный старт в N свежих процессах")
+    parser.add_argument("--late-failure", action="store_true",
+                        help="вместо прогона маршрутов проверить правки, когда поздний ответ ИИ упал")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.startup:
+        summary = measure_startup(args.startup)
+        print_startup(summary)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump({"commit": git_commit(), "startup": summary}, f, ensure_ascii=False, indent=2)
+        sys.exit(0)
+
+    random.seed(args.seed)
+    if args.late_failure:
+        # ИИ всегда отвечает дольше бюджета и с ошибкой.
+        args.llm_latency, args.llm_errors, args.jitter = 0.2, 1.0, 0.0
+        mismatches = asyncio.run(run(args))["late_failure"]
+        for line in mismatches:
+            print(line)
+        print("Поздние ошибки ИИ: " + ("расхождения" if mismatches else "OK"))
+        sys.exit(1 if mismatches else 0)
+
+    report = asyncio.run(run(args))
+    print_results(report["results"])
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            print_comparison(json.load(f), report["results"])
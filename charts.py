@@ -0,0 +1,127 @@
+# --- ГРАФИК ПРОГРЕССА ---
+
+# Рисует PNG со счётом по дням через Pillow (ImageDraw): столбцы дней,
+# полоса под сериями дней выше порога, пунктир цели и подписи осей.
+# Pillow импортируется лениво, как в images.py; без него render_score_chart
+# поднимает ImportError, и бот отвечает на /chart текстом.
+# Рендер занимает десятки миллисекунд, но всё равно вызывается из потока
+# (asyncio.to_thread), а не в цикле событий.
+
+import io
+
+WIDTH, HEIGHT = 900, 420
+MARGIN_LEFT, MARGIN_RIGHT, MARGIN_TOP, MARGIN_BOTTOM = 56, 16, 16, 48
+FONT_SIZE = 14
+
+COLORS = {
+    "background": (255, 255, 255),
+    "grid": (232, 232, 232),
+    "axis": (150, 150, 150),
+    "text": (90, 90, 90),
+    "goal": (214, 48, 49),
+    "above_goal": (39, 174, 96),
+    "above_threshold": (52, 120, 220),
+    "below": (170, 178, 189),
+    "negative": (231, 111, 81),
+    "streak": (243, 156, 18),
+}
+
+
+def _font():
+    from PIL import ImageFont
+
+    try:
+        return ImageFont.load_default(size=FONT_SIZE)
+    except TypeError:
+        # Pillow < 10.1: растровый шрифт по умолчанию без выбора размера.
+        return ImageFont.load_default()
+
+
+def _tick_step(span: float) -> int:
+    for step in (10, 20, 25, 50, 100, 200, 250, 500, 1000):
+        if span / step <= 6:
+            return step
+    return 2000
+
+
+def render_score_chart(dates: list, scores: list, goal: float = 100, threshold: float = 70,
+                       streak_min_days: int = 3) -> bytes:
+    """
+    PNG со счётом по дням: dates — "ГГГГ-ММ-ДД", scores — счёт тех же дней.
+    Серии от streak_min_days дней со счётом не ниже threshold подчёркнуты полосой.
+    """
+    from PIL import Image, ImageDraw
+
+    image = Image.new("RGB", (WIDTH, HEIGHT), COLORS["background"])
+    draw = ImageDraw.Draw(image)
+    font = _font()
+    left, right = MARGIN_LEFT, WIDTH - MARGIN_RIGHT
+    top, bottom = MARGIN_TOP, HEIGHT - MARGIN_BOTTOM
+    count = max(1, len(scores))
+
+    y_max = max([goal * 1.2] + [score * 1.1 for score in scores])
+    y_min = min([0] + [score * 1.1 for score in scores])
+
+    def y_of(value: float) -> int:
+        return int(top + (y_max - value) / (y_max - y_min) * (bottom - top))
+
+    # Сетка и подписи шкалы.
+    step = _tick_step(y_max - y_min)
+    tick = int(y_min // step) * step
+    while tick <= y_max:
+        y = y_of(tick)
+        if top <= y <= bottom:
+            draw.line((left, y, right, y), fill=COLORS["grid"])
+            draw.text((left - 8, y), str(tick), fill=COLORS["text"], font=font, anchor="rm")
+        tick += step
+
+    # Столбцы дней. Узкие слоты (год) заливаются целиком, иначе столбцы тонут в просветах.
+    slot = (right - left) / count
+    bar = max(1, int(slot * 0.7) if slot >= 4 else int(slot))
+    zero = y_of(0)
+    for index, score in enumerate(scores):
+        x = left + int(index * slot + (slot - bar) / 2)
+        if score >= goal:
+            color = COLORS["above_goal"]
+        elif score >= threshold:
+            color = COLORS["above_threshold"]
+        elif score >= 0:
+            color = COLORS["below"]
+        else:
+            color = COLORS["negative"]
+        y = y_of(score)
+        if y != zero:
+            draw.rectangle((x, min(y, zero), x + bar - 1, max(y, zero) - 1), fill=color)
+
+    # Полоса под сериями.
+    run_start = None
+    for index, score in enumerate(list(scores) + [float("-inf")]):
+        if score >= threshold:
+            if run_start is None:
+                run_start = index
+        elif run_start is not None:
+            if index - run_start >= streak_min_days:
+                draw.rectangle((left + int(run_start * slot), bottom + 3, left + int(index * slot) - 1, bottom + 7),
+                               fill=COLORS["streak"])
+            run_start = None
+
+    # Оси и пунктир цели.
+    draw.line((left, zero, right, zero), fill=COLORS["axis"])
+    draw.line((left - 1, top, left - 1, bottom), fill=COLORS["axis"])
+    goal_y = y_of(goal)
+    for x in range(left, right, 12):
+        draw.line((x, goal_y, min(x + 7, right), goal_y), fill=COLORS["goal"], width=2)
+    # Только цифры и точки: во встроенном шрифте Pillow нет кириллицы.
+    draw.text((right, goal_y - 4), f"{goal:g}", fill=COLORS["goal"], font=font, anchor="rb")
+
+    # Подписи дат (ДД.ММ) примерно в шести точках.
+    if dates:
+        every = max(1, len(dates) // 6)
+        for index in range(0, len(dates), every):
+            label = f"{dates[index][8:10]}.{dates[index][5:7]}"
+            x = left + int(index * slot + slot / 2)
+            draw.text((x, bottom + 12), label, fill=COLORS["text"], font=font, anchor="mt")
+
+    out = io.BytesIO()
+    image.save(out, "PNG", optimize=True)
+    return out.getvalue()
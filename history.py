@@ -0,0 +1,244 @@
+# --- ЭКСПОРТ И ИМПОРТ ИСТОРИИ ---
+
+# Выгружает и загружает actions_log, scores, challenges и daily_plan,
+# а также дневные агрегаты actions_daily (сырые строки архивированных дней
+# лежат в архивной базе и сюда не попадают),
+# в NDJSON или CSV, сжатые gzip. Курсор читается пачками (fetchmany) и пишется
+# сразу в gzip-поток, а импорт читает файл построчно, поэтому память
+# не зависит от длины истории.
+#
+# Импорт пишет пачками, по транзакции на пачку, и пропускает строки, которые
+# уже были в базе до импорта: повторный импорт того же файла ничего не дублирует,
+# а прерванный можно просто запустить ещё раз. Сырые строки дней, которые уже
+# свёрнуты в actions_daily (архивированы после выгрузки), тоже пропускаются —
+# иначе день считался бы дважды: агрегатом и вернувшимися строками. В конце scores пересчитываются
+# по actions_log и actions_daily для всех затронутых дней.
+#
+# Используется командами /export и /import в main.py и из командной строки:
+#   python history.py export --format csv --output history.csv.gz
+#   python history.py import history.csv.gz
+
+import argparse
+import csv
+import gzip
+import io
+import json
+import os
+import sys
+from datetime import datetime, timedelta
+
+# Таблицы и колонки, которые переносятся, в порядке выгрузки.
+TABLES = {
+    "actions_log": ("timestamp", "action", "points", "type"),
+    "scores": ("date", "score"),
+    "challenges": ("challenge_name", "start_date", "end_date", "goal_value", "description", "action", "progress"),
+    "daily_plan": ("date", "user_id", "plan_item", "is_completed", "status"),
+    "actions_daily": ("date", "action", "type", "count", "points"),
+}
+FORMATS = ("ndjson", "csv")
+
+# Сколько строк курсор отдаёт за раз при выгрузке.
+EXPORT_CHUNK_ROWS = 1000
+# Сколько строк пишется одной транзакцией при импорте.
+IMPORT_BATCH_ROWS = 1000
+
+# В CSV перед строками каждой таблицы идёт строка "@table,<имя>,<колонки...>".
+CSV_TABLE_MARKER = "@table"
+
+# Вставка, пропускающая строки, которые были в базе до импорта (rowid <= снимка).
+# Одинаковые строки внутри файла (два нажатия за секунду) при этом сохраняются.
+# Строки журнала за дни, уже свёрнутые в actions_daily, не вставляются.
+_INSERT_SQL = {
+    "actions_log": "INSERT INTO actions_log (timestamp, action, points, type) SELECT ?, ?, ?, ? "
+                   "WHERE NOT EXISTS (SELECT 1 FROM actions_log WHERE timestamp IS ? AND action IS ? "
+                   "AND points IS ? AND type IS ? AND rowid <= ?) "
+                   "AND NOT EXISTS (SELECT 1 FROM actions_daily WHERE date = substr(?, 1, 10))",
+    "scores": "INSERT OR IGNORE INTO scores (date, score) VALUES (?, ?)",
+    # В выгрузках до привязки к действиям нет action и progress: счётчик тогда начинается с нуля.
+    "challenges": "INSERT OR IGNORE INTO challenges (challenge_name, start_date, end_date, goal_value, description, "
+                  "action, progress) VALUES (?, ?, ?, ?, ?, ?, COALESCE(?, 0))",
+    "daily_plan": "INSERT INTO daily_plan (date, user_id, plan_item, is_completed, status) SELECT ?, ?, ?, ?, ? "
+                  "WHERE NOT EXISTS (SELECT 1 FROM daily_plan WHERE date IS ? AND user_id IS ? "
+                  "AND plan_item IS ? AND rowid <= ?)",
+    "actions_daily": "INSERT OR IGNORE INTO actions_daily (date, action, type, count, points) VALUES (?, ?, ?, ?, ?)",
+}
+
+
+def _iter_rows(conn, table: str):
+    """Строки таблицы в порядке вставки, пачками по EXPORT_CHUNK_ROWS."""
+    c = conn.cursor()
+    c.arraysize = EXPORT_CHUNK_ROWS
+    c.execute(f"SELECT {', '.join(TABLES[table])} FROM {table} ORDER BY rowid")
+    while True:
+        rows = c.fetchmany()
+        if not rows:
+            return
+        yield from rows
+
+
+def export_history(conn, out, fmt: str = "ndjson") -> dict:
+    """
+    Пишет все таблицы истории в бинарный поток out как gzip (NDJSON или CSV).
+    Возвращает число выгруженных строк по таблицам.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Неизвестный формат '{fmt}', доступны: {', '.join(FORMATS)}")
+    counts = {}
+    with gzip.GzipFile(fileobj=out, mode="wb") as packed, \
+            io.TextIOWrapper(packed, encoding="utf-8", newline="") as text:
+        writer = csv.writer(text) if fmt == "csv" else None
+        for table, columns in TABLES.items():
+            counts[table] = 0
+            if writer:
+                writer.writerow([CSV_TABLE_MARKER, table, *columns])
+            for row in _iter_rows(conn, table):
+                if writer:
+                    writer.writerow(["" if value is None else value for value in row])
+                else:
+                    text.write(json.dumps({"table": table, **dict(zip(columns, row))}, ensure_ascii=False) + "\n")
+                counts[table] += 1
+    return counts
+
+
+def open_history(path: str):
+    """Открывает выгрузку как текстовый поток; gzip распознаётся по сигнатуре."""
+    with open(path, "rb") as f:
+        packed = f.read(2) == b"\x1f\x8b"
+    if packed:
+        return gzip.open(path, "rt", encoding="utf-8", newline="")
+    return open(path, "r", encoding="utf-8", newline="")
+
+
+def read_history(stream):
+    """Лениво читает выгрузку (формат определяется по первой строке) в пары (таблица, строка-словарь)."""
+    first = stream.readline()
+    if not first.strip():
+        return
+    if first.lstrip().startswith("{"):
+        for line in _chain_line(first, stream):
+            if line.strip():
+                record = json.loads(line)
+                yield record.pop("table", None), record
+        return
+
+    table, columns = None, ()
+    for row in csv.reader(_chain_line(first, stream)):
+        if row and row[0] == CSV_TABLE_MARKER:
+            table, columns = row[1], row[2:]
+        elif row and table:
+            yield table, {column: (value if value != "" else None) for column, value in zip(columns, row)}
+
+
+def _chain_line(first: str, stream):
+    yield first
+    yield from stream
+
+
+def _next_day(date: str) -> str:
+    return (datetime.strptime(date, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
+
+
+def rebuild_scores(conn, dates) -> int:
+    """Пересчитывает scores как сумму баллов журнала и дневных агрегатов для дней, где есть действия."""
+    c = conn.cursor()
+    c.executemany("INSERT OR REPLACE INTO scores (date, score) SELECT ?, total FROM ("
+                  "SELECT SUM(points) AS total, COUNT(*) AS n FROM ("
+                  "SELECT points FROM actions_log WHERE timestamp >= ? AND timestamp < ? "
+                  "UNION ALL SELECT points FROM actions_daily WHERE date = ?)) WHERE n > 0",
+                  ((date, date, _next_day(date), date) for date in sorted(dates)))
+    conn.commit()
+    return len(dates)
+
+
+def import_history(conn, stream) -> dict:
+    """
+    Загружает выгрузку из текстового потока пачками по IMPORT_BATCH_ROWS, транзакция на пачку.
+    Строки, которые уже были в базе, пропускаются. В конце пересчитывает scores
+    затронутых дней. Возвращает число добавленных строк по таблицам и число пропущенных.
+    """
+    c = conn.cursor()
+    snapshot = {table: c.execute(f"SELECT COALESCE(MAX(rowid), 0) FROM {table}").fetchone()[0]
+                for table in ("actions_log", "daily_plan")}
+    counts = {table: 0 for table in TABLES}
+    counts["skipped"] = 0
+    batches = {table: [] for table in TABLES}
+    touched_dates = set()
+
+    def flush(table):
+        rows = batches[table]
+        if not rows:
+            return
+        before = conn.total_changes
+        c.executemany(_INSERT_SQL[table], rows)
+        conn.commit()
+        added = conn.total_changes - before
+        counts[table] += added
+        counts["skipped"] += len(rows) - added
+        rows.clear()
+
+    for table, record in read_history(stream):
+        columns = TABLES.get(table)
+        if columns is None:
+            counts["skipped"] += 1
+            continue
+        values = tuple(record.get(column) for column in columns)
+        if table == "actions_log":
+            values += values + (snapshot["actions_log"], values[0])
+            if values[0]:
+                touched_dates.add(str(values[0])[:10])
+        elif table == "daily_plan":
+            values += values[:3] + (snapshot["daily_plan"],)
+        elif table in ("scores", "actions_daily") and values[0]:
+            touched_dates.add(str(values[0]))
+        batches[table].append(values)
+        if len(batches[table]) >= IMPORT_BATCH_ROWS:
+            flush(table)
+
+    for table in TABLES:
+        flush(table)
+    rebuild_scores(conn, touched_dates)
+    return counts
+
+
+def format_counts(counts: dict) -> str:
+    """Короткая сводка для ответа в чат и CLI."""
+    return ", ".join(f"{name}: {count}" for name, count in counts.items())
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description="Экспорт и импорт истории бота.")
+    parser.add_argument("--db", default="", help="файл базы (по умолчанию BOT_DB_PATH или bot_data.db)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export", help="выгрузить историю в gzip")
+    export_parser.add_argument("--format", choices=FORMATS, default="ndjson")
+    export_parser.add_argument("--output", default="-", help="файл выгрузки (- — stdout)")
+    import_parser = commands.add_parser("import", help="загрузить выгрузку (gzip или обычный текст)")
+    import_parser.add_argument("path")
+    args = parser.parse_args(argv)
+
+    from dotenv import load_dotenv
+    load_dotenv()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main
+    main.DB_PATH = args.db or os.getenv("BOT_DB_PATH") or main.DB_PATH
+    main.init_db()
+
+    conn = main.connect_db()
+    try:
+        if args.command == "export":
+            if args.output == "-":
+                counts = export_history(conn, sys.stdout.buffer, args.format)
+            else:
+                with open(args.output, "wb") as out:
+                    counts = export_history(conn, out, args.format)
+            print(f"Выгружено: {format_counts(counts)}", file=sys.stderr)
+        else:
+            with open_history(args.path) as stream:
+                counts = import_history(conn, stream)
+            print(f"Загружено: {format_counts(counts)}", file=sys.stderr)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,225 @@
+# --- КОНВЕЙЕР ИЗОБРАЖЕНИЙ ---
+
+# Imagen отдаёт PNG на мегабайты. Перед отправкой картинка уменьшается до
+# MAX_SIDE по большей стороне и перекодируется в JPEG или WebP с заданным
+# качеством — в отдельном пуле потоков, чтобы не занимать ни цикл событий,
+# ни общий пул asyncio.to_thread, где ждут ответы ИИ.
+#
+# Готовые картинки лежат на диске под хэшем промпта (с учётом формата и качества),
+# а file_id, который Telegram вернул при первой отправке, запоминается:
+# повторный показ — это только file_id, без генерации и без загрузки файла.
+# Для постоянных промптов (иллюстрация анализа дня) держится пул из нескольких
+# вариантов: показывается случайный готовый, недостающие догенерируются в фоне.
+# Одновременные промахи по одному варианту ждут одну и ту же генерацию.
+# Проверки файлов на диске идут в потоке, а не в цикле событий.
+#
+# Pillow импортируется лениво; без него картинки уходят как есть.
+
+import asyncio
+import hashlib
+import importlib.util
+import io
+import logging
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from aiogram.types import BufferedInputFile
+
+import metrics
+
+FORMATS = {"jpeg": ("JPEG", "jpg"), "webp": ("WEBP", "webp")}
+
+_settings = {"format": "jpeg", "quality": 85, "max_side": 1280, "cache_dir": "image_cache", "max_files": 500}
+_pool = None
+_spawn = None
+# Ключ варианта -> file_id Telegram.
+_file_ids = {}
+# Базовые ключи пулов, которые сейчас догенерируются.
+_filling = set()
+# Ключ варианта -> задача его генерации, пока она идёт.
+_producing = {}
+
+
+def configure(cache_dir: str, fmt: str = "jpeg", quality: int = 85, max_side: int = 1280, workers: int = 2,
+              max_files: int = 500, spawn=None):
+    """
+    Задаёт параметры конвейера. spawn(coro) запускает фоновую догенерацию
+    (в боте — run_in_background, чтобы остановка её дождалась).
+    """
+    global _pool, _spawn
+    if fmt not in FORMATS:
+        raise ValueError(f"Неизвестный формат изображений '{fmt}', доступны: {', '.join(FORMATS)}")
+    _settings.update(format=fmt, quality=quality, max_side=max_side, cache_dir=cache_dir, max_files=max_files)
+    if _pool is not None:
+        _pool.shutdown(wait=False)
+    _pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="images")
+    _spawn = spawn
+    if importlib.util.find_spec("PIL") is None:
+        logging.warning("Pillow не установлен: картинки отправляются без перекодирования.")
+
+
+def shutdown():
+    """Дожидается начатых перекодирований и закрывает пул."""
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=True)
+        _pool = None
+
+
+@metrics.timed("bot_image_seconds", stage="transcode")
+def transcode(data: bytes) -> tuple:
+    """Уменьшает и перекодирует картинку. Возвращает (байты, расширение); без выигрыша — исходник."""
+    try:
+        from PIL import Image
+    except ImportError:
+        return data, "png"
+
+    pil_format, extension = FORMATS[_settings["format"]]
+    max_side = _settings["max_side"]
+    with Image.open(io.BytesIO(data)) as image:
+        image.load()
+        if max(image.size) > max_side:
+            image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        out = io.BytesIO()
+        if pil_format == "JPEG":
+            image.save(out, pil_format, quality=_settings["quality"], optimize=True, progressive=True)
+        else:
+            image.save(out, pil_format, quality=_settings["quality"], method=4)
+    result = out.getvalue()
+    if len(result) >= len(data):
+        return data, "png"
+    return result, extension
+
+
+def prompt_key(prompt: str) -> str:
+    """Хэш нормализованного промпта вместе с настройками кодирования."""
+    normalized = " ".join(prompt.lower().split())
+    settings = f"{_settings['format']}|{_settings['quality']}|{_settings['max_side']}"
+    return hashlib.sha256(f"{normalized}|{settings}".encode("utf-8")).hexdigest()[:24]
+
+
+def _path(key: str):
+    """Путь к файлу варианта на диске (с любым расширением) или None."""
+    for extension in ("jpg", "webp", "png"):
+        path = os.path.join(_settings["cache_dir"], f"{key}.{extension}")
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def _store(key: str, raw: bytes) -> str:
+    """В пуле: перекодирует и кладёт на диск, вытесняя самые старые файлы сверх лимита."""
+    data, extension = transcode(raw)
+    os.makedirs(_settings["cache_dir"], exist_ok=True)
+    path = os.path.join(_settings["cache_dir"], f"{key}.{extension}")
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
+    metrics.inc("bot_image_bytes_total", stage="generated", value=len(raw))
+    metrics.inc("bot_image_bytes_total", stage="stored", value=len(data))
+
+    files = [os.path.join(_settings["cache_dir"], name) for name in os.listdir(_settings["cache_dir"])]
+    if len(files) > _settings["max_files"]:
+        files.sort(key=os.path.getmtime)
+        for old in files[:len(files) - _settings["max_files"]]:
+            os.remove(old)
+    return path
+
+
+def _on_disk(keys: list) -> set:
+    """Ключи вариантов, файлы которых лежат на диске."""
+    return {key for key in keys if _path(key) is not None}
+
+
+def _read(key: str) -> tuple:
+    """В пуле: (путь, байты) варианта или (None, None), если файл уже вытеснен."""
+    path = _path(key)
+    if path is None:
+        return None, None
+    try:
+        with open(path, "rb") as f:
+            return path, f.read()
+    except FileNotFoundError:
+        return None, None
+
+
+async def _produce(key: str, prompt: str, generate) -> bool:
+    """Генерирует вариант (generate — блокирующий вызов API) и сохраняет его перекодированным."""
+    started = time.perf_counter()
+    raw = await asyncio.to_thread(generate, prompt)
+    if not raw:
+        return False
+    await asyncio.get_running_loop().run_in_executor(_pool, _store, key, raw)
+    logging.info("Картинка %s готова за %.1f с.", key, time.perf_counter() - started)
+    return True
+
+
+async def _produce_once(key: str, prompt: str, generate) -> bool:
+    """_produce, общий для всех, кому вариант key нужен одновременно."""
+    task = _producing.get(key)
+    if task is None:
+        task = _producing[key] = asyncio.ensure_future(_produce(key, prompt, generate))
+        task.add_done_callback(lambda _: _producing.pop(key, None))
+    # shield: отмена одного ожидающего не должна обрывать генерацию для остальных.
+    return await asyncio.shield(task)
+
+
+async def fill(prompt: str, generate, variants: int):
+    """Догенерирует недостающие варианты пула для постоянного промпта."""
+    base = prompt_key(prompt)
+    if base in _filling:
+        return
+    _filling.add(base)
+    try:
+        keys = [f"{base}-{index}" for index in range(variants)]
+        on_disk = await asyncio.to_thread(_on_disk, keys)
+        for key in keys:
+            if key not in _file_ids and key not in on_disk and not await _produce_once(key, prompt, generate):
+                return
+    finally:
+        _filling.discard(base)
+
+
+async def get_photo(prompt: str, generate, variants: int = 1):
+    """
+    Картинка для промпта: (ключ, file_id или BufferedInputFile) либо (None, None), если сгенерировать не вышло.
+    После отправки передай ключ и сообщение в remember(), чтобы следующий показ ушёл по file_id.
+    """
+    base = prompt_key(prompt)
+    keys = [f"{base}-{index}" for index in range(variants)]
+    on_disk = await asyncio.to_thread(_on_disk, [key for key in keys if key not in _file_ids])
+    ready = [key for key in keys if key in _file_ids or key in on_disk]
+    if ready:
+        metrics.inc("bot_cache_requests_total", cache="image", result="hit")
+        key = random.choice(ready)
+    else:
+        metrics.inc("bot_cache_requests_total", cache="image", result="miss")
+        key = keys[0]
+        if not await _produce_once(key, prompt, generate):
+            return None, None
+    if variants > 1 and len(ready) < variants and base not in _filling:
+        (_spawn or asyncio.ensure_future)(fill(prompt, generate, variants))
+
+    file_id = _file_ids.get(key)
+    if file_id:
+        return key, file_id
+    loop = asyncio.get_running_loop()
+    path, data = await loop.run_in_executor(_pool, _read, key)
+    if path is None:
+        # Файл вытеснили между проверкой и чтением — генерируем вариант заново.
+        if not await _produce_once(key, prompt, generate):
+            return None, None
+        path, data = await loop.run_in_executor(_pool, _read, key)
+        if path is None:
+            return None, None
+    return key, BufferedInputFile(data, filename=os.path.basename(path))
+
+
+def remember(key: str, message):
+    """Запоминает file_id отправленной картинки для повторных показов."""
+    if key and message is not None and getattr(message, "photo", None):
+        _file_ids[key] = message.photo[-1].file_id
@@ -0,0 +1,145 @@
+# --- НЕБЛОКИРУЮЩЕЕ СТРУКТУРНОЕ ЛОГИРОВАНИЕ ---
+
+# Обработчики и планировщик только кладут запись в очередь (QueueHandler),
+# а форматирование в JSON и запись в поток делает отдельный поток
+# (QueueListener). Сообщение собирается из msg % args уже в этом потоке,
+# поэтому логи пишутся в %-стиле: logging.info("Счёт: %s", score).
+#
+# Каждая запись — одна строка JSON: время, уровень, сообщение и контекст
+# апдейта (update_id, user_id, route), который middleware кладёт в contextvars,
+# плюс duration_ms, если он передан через extra (middleware пишет его в итоговой
+# INFO-записи каждого апдейта, медленные — WARNING). DEBUG-записи прореживаются:
+# пропускается одна из DEBUG_SAMPLE_EVERY. Если очередь переполнена, запись
+# отбрасывается и считается в метрике, а обработчик не ждёт.
+
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+from datetime import datetime
+
+import metrics
+
+# Предел очереди записей; при переполнении новые записи отбрасываются.
+QUEUE_SIZE = 10000
+# Контекстные поля записи.
+CONTEXT_FIELDS = ("update_id", "user_id", "route")
+
+_context = contextvars.ContextVar("log_context", default=None)
+_listener = None
+
+
+def bind(**fields):
+    """Задаёт контекст апдейта для всех записей текущей задачи. Возвращает токен для reset."""
+    return _context.set(fields)
+
+
+def reset(token):
+    """Возвращает предыдущий контекст."""
+    _context.reset(token)
+
+
+class ContextFilter(logging.Filter):
+    """Прикрепляет к записи контекст апдейта в момент вызова (в потоке обработчика)."""
+
+    def filter(self, record):
+        context = _context.get()
+        if context:
+            for field, value in context.items():
+                if not hasattr(record, field):
+                    setattr(record, field, value)
+        return True
+
+
+class DebugSampler(logging.Filter):
+    """Пропускает каждую every-ю DEBUG-запись; остальные уровни — все."""
+
+    def __init__(self, every: int):
+        super().__init__()
+        self.every = max(1, every)
+        self._seen = 0
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self.every == 1:
+            return True
+        with self._lock:
+            self._seen += 1
+            return self._seen % self.every == 1
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler без форматирования в вызывающем потоке и без ожидания на полной очереди."""
+
+    def prepare(self, record):
+        # Стандартный prepare форматирует запись сразу; здесь это делает поток записи.
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.inc("bot_log_dropped_total", level=record.levelname)
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись — одна строка JSON."""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        duration = getattr(record, "duration_ms", None)
+        if duration is not None:
+            entry["duration_ms"] = round(duration, 3)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def setup(level=logging.INFO, debug_sample_every: int = 100, stream=None):
+    """
+    Переключает корневой логгер на очередь с потоком записи в stream (по умолчанию stderr).
+    Повторный вызов перенастраивает уровень и прореживание.
+    """
+    global _listener
+    if _listener is not None:
+        shutdown()
+
+    writer = logging.StreamHandler(stream or sys.stderr)
+    writer.setFormatter(JsonFormatter())
+    records = queue.Queue(QUEUE_SIZE)
+    handler = BoundedQueueHandler(records)
+    handler.addFilter(DebugSampler(debug_sample_every))
+    handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(records, writer)
+    _listener.start()
+
+
+def shutdown():
+    """Дописывает всё, что осталось в очереди, и останавливает поток записи."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(shutdown)
@@ -0,0 +1,427 @@
+# --- НАГРУЗОЧНЫЙ ГЕНЕРАТОР ДЛЯ БАЛЛОВ И ПЛАНОВ ---
+
+# Заполняет базу синтетической историей (N пользователей, M дней, случайные действия
+# и провалы из каталога main.py), а затем воспроизводит смешанную нагрузку
+# на update_stats, get_daily_score, get_daily_plan, complete_plan_item и add_plan_item
+# с заданной частотой. Показывает задержки функций БД, время записи с ожиданием
+# блокировки, ошибки "database is locked" и рост файла базы.
+#
+# Таблицы scores и actions_log в боте общие (без user_id), поэтому действия всех
+# синтетических пользователей попадают в них вместе; daily_plan заполняется по user_id.
+#
+# С --analytics вместо нагрузки замеряется отчёт analytics.py по всей истории
+# против прежнего подхода — запросов по каждому дню в цикле.
+#
+# С --history-roundtrip вместо нагрузки проверяется, что выгрузка, архивация
+# половины истории и повторный импорт той же выгрузки (дважды) не меняют
+# ни сводок по дням, ни счёта. При расхождении процесс завершается с кодом 1.
+#
+# Пример:
+#   python loadgen.py --users 20 --days 365 --rate 200 --duration 30 --output loadgen_results.json
+#   python loadgen.py --users 1 --days 1826 --analytics
+#   python loadgen.py --users 2 --days 120 --history-roundtrip
+
+import argparse
+import gzip
+import io
+import json
+import math
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+# Доли операций в смешанной нагрузке.
+WORKLOAD_MIX = {
+    "update_stats": 0.5,
+    "get_daily_score": 0.3,
+    "get_daily_plan": 0.1,
+    "complete_plan_item": 0.05,
+    "add_plan_item": 0.05,
+}
+
+PLAN_ITEMS = ["deep work 2 часа", "кодинг", "тренировка", "чтение 30 минут", "контент", "английский", "звонок клиенту"]
+
+
+def import_bot(db_path: str):
+    """Импортирует main.py с временной базой; настоящие токены для замера не нужны."""
+    os.environ["BOT_DB_PATH"] = db_path
+    os.environ["BOT_ARCHIVE_DB_PATH"] = os.path.join(os.path.dirname(db_path), "loadgen_archive.db")
+    for key, value in (("BOT_TOKEN", "123456:LOADGEN-TOKEN"), ("CHAT_ID", "1"),
+                       ("OPENROUTER_API_KEY", "loadgen"), ("GOOGLE_AI_API_KEY", "loadgen")):
+        os.environ.setdefault(key, value)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main
+    main.load_config()
+    main.init_db()
+    return main
+
+
+def db_size(db_path: str) -> int:
+    """Размер базы вместе с журналом и WAL, в байтах."""
+    return sum(os.path.getsize(path) for path in (db_path, f"{db_path}-journal", f"{db_path}-wal")
+               if os.path.exists(path))
+
+
+# --- ИЗМЕРЯЕМОЕ СОЕДИНЕНИЕ ---
+
+class TimedCursor:
+    """Курсор, который засекает время операторов записи (включая ожидание блокировки)."""
+
+    def __init__(self, cursor, stats):
+        self._cursor = cursor
+        self._stats = stats
+
+    def execute(self, sql, params=()):
+        started = time.perf_counter()
+        try:
+            return self._cursor.execute(sql, params)
+        finally:
+            if not sql.lstrip().upper().startswith("SELECT"):
+                self._stats["write"] += time.perf_counter() - started
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class TimedConnection:
+    """Соединение, которое засекает время commit и отдаёт TimedCursor."""
+
+    def __init__(self, conn, stats):
+        self._conn = conn
+        self._stats = stats
+
+    def cursor(self):
+        return TimedCursor(self._conn.cursor(), self._stats)
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            self._conn.commit()
+        finally:
+            self._stats["write"] += time.perf_counter() - started
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+def instrument(main):
+    """Подменяет main.connect_db измеряемой версией. Возвращает thread-local статистику."""
+    original_connect = main.connect_db
+    local = threading.local()
+
+    def timed_connect():
+        return TimedConnection(original_connect(), local.stats)
+
+    main.connect_db = timed_connect
+    return local
+
+
+# --- ЗАПОЛНЕНИЕ ИСТОРИИ ---
+
+def populate(main, db_path: str, users: int, days: int, actions_per_day: float, seed: int):
+    """Заливает синтетическую историю одной транзакцией на день."""
+    rng = random.Random(seed)
+    action_names = list(main.actions)
+    failure_names = list(main.failures)
+    today = datetime.now().date()
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    started = time.perf_counter()
+    rows = 0
+
+    for day_offset in range(days, 0, -1):
+        day = today - timedelta(days=day_offset)
+        date = day.strftime("%Y-%m-%d")
+        log_rows = []
+        plan_rows = []
+        for user in range(users):
+            count = max(0, int(rng.lognormvariate(math.log(actions_per_day), 0.4)))
+            for _ in range(count):
+                moment = datetime(day.year, day.month, day.day, rng.randint(6, 23), rng.randint(0, 59),
+                                  rng.randint(0, 59)).strftime("%Y-%m-%d %H:%M:%S")
+                if rng.random() < 0.12:
+                    name = rng.choice(failure_names)
+                    log_rows.append((moment, name, main.failures[name], "провал"))
+                else:
+                    name = rng.choice(action_names)
+                    log_rows.append((moment, name, main.actions[name], "действие"))
+                    if rng.random() < 0.05:
+                        log_rows.append((moment, name, -main.actions[name], "отмена"))
+            for item in rng.sample(PLAN_ITEMS, rng.randint(2, 5)):
+                plan_rows.append((date, str(user + 1), item, int(rng.random() < 0.6)))
+
+        c.executemany("INSERT INTO actions_log (timestamp, action, points, type) VALUES (?, ?, ?, ?)", log_rows)
+        c.executemany("INSERT INTO daily_plan (date, user_id, plan_item, is_completed) VALUES (?, ?, ?, ?)",
+                      plan_rows)
+        c.execute("INSERT OR REPLACE INTO scores (date, score) VALUES (?, ?)",
+                  (date, sum(row[2] for row in log_rows)))
+        conn.commit()
+        rows += len(log_rows) + len(plan_rows) + 1
+
+    conn.close()
+    return rows, time.perf_counter() - started
+
+
+# --- ВОСПРОИЗВЕДЕНИЕ НАГРУЗКИ ---
+
+def run_operation(main, rng, name: str, today: str, plan_rowids: list):
+    """Выполняет одну операцию нагрузки."""
+    if name == "update_stats":
+        if rng.random() < 0.12:
+            failure = rng.choice(list(main.failures))
+            main.update_stats(main.failures[failure], failure, "провал")
+        else:
+            action = rng.choice(list(main.actions))
+            main.update_stats(main.actions[action], action, "действие")
+    elif name == "get_daily_score":
+        main.get_daily_score(today)
+    elif name == "get_daily_plan":
+        main.get_daily_plan(today)
+    elif name == "complete_plan_item":
+        main.complete_plan_item(rng.choice(plan_rowids))
+    elif name == "add_plan_item":
+        main.add_plan_item(today, rng.choice(PLAN_ITEMS))
+
+
+def percentile(sorted_values: list, q: float) -> float:
+    """Перцентиль по методу ближайшего ранга."""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, math.ceil(q / 100 * len(sorted_values)) - 1)]
+
+
+def replay(main, db_path: str, rate: float, duration: float, workers: int, seed: int) -> dict:
+    """
+    Воспроизводит смешанную нагрузку с постоянной частотой (открытая модель:
+    запросы не ждут друг друга, очередь растёт, если база не успевает).
+    """
+    local = instrument(main)
+    rng = random.Random(seed + 1)
+    names, weights = zip(*WORKLOAD_MIX.items())
+    today = datetime.now().strftime("%Y-%m-%d")
+
+    conn = sqlite3.connect(db_path)
+    plan_rowids = [row[0] for row in conn.execute("SELECT rowid FROM daily_plan ORDER BY rowid DESC LIMIT 5000")]
+    conn.close()
+    plan_rowids = plan_rowids or [1]
+
+    samples = {name: [] for name in names}
+    size_samples = []
+    errors = {"locked": 0, "other": 0}
+    errors_lock = threading.Lock()
+
+    def task(name, scheduled, task_seed):
+        local.stats = {"write": 0.0}
+        started = time.perf_counter()
+        try:
+            run_operation(main, random.Random(task_seed), name, today, plan_rowids)
+        except sqlite3.OperationalError as e:
+            with errors_lock:
+                errors["locked" if "locked" in str(e) else "other"] += 1
+        except Exception:
+            with errors_lock:
+                errors["other"] += 1
+        finished = time.perf_counter()
+        samples[name].append((finished - started, started - scheduled, local.stats["write"]))
+
+    total = int(rate * duration)
+    interval = 1.0 / rate
+    begin = time.perf_counter()
+    last_size_sample = begin
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for i in range(total):
+            scheduled = begin + i * interval
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(task, rng.choices(names, weights)[0], scheduled, rng.random())
+            if scheduled - last_size_sample >= 1.0:
+                size_samples.append((round(scheduled - begin, 2), db_size(db_path)))
+                last_size_sample = scheduled
+    elapsed = time.perf_counter() - begin
+    size_samples.append((round(elapsed, 2), db_size(db_path)))
+
+    operations = []
+    for name, values in samples.items():
+        latencies = sorted(v[0] for v in values)
+        queue = sorted(v[1] for v in values)
+        writes = sorted(v[2] for v in values)
+        operations.append({
+            "operation": name,
+            "count": len(values),
+            "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+            "queue_p95_ms": round(percentile(queue, 95) * 1000, 3),
+            "write_p95_ms": round(percentile(writes, 95) * 1000, 3),
+            "write_max_ms": round((writes[-1] if writes else 0) * 1000, 3),
+        })
+
+    return {
+        "requested_rate": rate,
+        "achieved_rate": round(total / elapsed, 2) if elapsed else 0.0,
+        "errors": errors,
+        "operations": operations,
+        "size_samples": size_samples,
+    }
+
+
+# --- ЗАМЕР АНАЛИТИКИ ---
+
+def bench_analytics(main, repeats: int = 5) -> dict:
+    """Время отчёта по всей истории: загрузка колонок + расчёт против запросов по каждому дню."""
+    import analytics
+
+    load_times, build_times = [], []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        conn = main.connect_db()
+        history = analytics.load_history(conn)
+        conn.close()
+        loaded = time.perf_counter()
+        analytics.build_report(history, analytics.PERIODS["month"])
+        load_times.append(loaded - started)
+        build_times.append(time.perf_counter() - loaded)
+
+    # Прежний путь: по запросу счёта и сводки журнала на каждый день истории.
+    started = time.perf_counter()
+    for index in range(history.days):
+        day = history.day(index).isoformat()
+        main.get_daily_score(day)
+        main.get_daily_action_summary(day)
+    per_day_seconds = time.perf_counter() - started
+
+    return {
+        "history_days": history.days,
+        "load_ms": round(min(load_times) * 1000, 1),
+        "build_ms": round(min(build_times) * 1000, 1),
+        "per_day_queries_ms": round(per_day_seconds * 1000, 1),
+    }
+
+
+def check_history_roundtrip(main, days: int) -> dict:
+    """
+    Выгрузка -> архивация старшей половины истории -> импорт той же выгрузки, дважды.
+    Сводки по дням и счёт должны совпасть с исходными. Возвращает расхождения.
+    """
+    import history
+
+    dates = [(datetime.now().date() - timedelta(days=offset)).isoformat() for offset in range(days, 0, -1)]
+
+    def snapshot():
+        return {date: (sorted((action, count, round(points, 6))
+                              for action, count, points in main.get_daily_action_summary(date)),
+                       round(main.get_daily_score(date), 6)) for date in dates}
+
+    before = snapshot()
+    exported = io.BytesIO()
+    conn = main.connect_db()
+    history.export_history(conn, exported, "ndjson")
+    conn.close()
+    compacted = main.compact_actions_log(max(1, days // 2))
+
+    mismatches = []
+    for attempt in (1, 2):
+        exported.seek(0)
+        conn = main.connect_db()
+        with io.TextIOWrapper(gzip.GzipFile(fileobj=exported), encoding="utf-8") as stream:
+            history.import_history(conn, stream)
+        conn.close()
+        after = snapshot()
+        mismatches += [{"import": attempt, "date": date, "before": before[date], "after": after[date]}
+                       for date in dates if before[date] != after[date]]
+    return {"days": days, "archived_days": compacted["days"], "mismatches": mismatches}
+
+
+def print_report(report: dict):
+    """Печатает итог прогона."""
+    p = report["populate"]
+    print(f"История: {p['rows']} строк за {p['seconds']:.1f} с, база {p['size_before']} -> {p['size_after']} байт")
+    if "roundtrip" in report:
+        rt = report["roundtrip"]
+        print(f"Круг выгрузка/архивация/импорт: {rt['days']} дней, архивировано {rt['archived_days']}, "
+              f"расхождений {len(rt['mismatches'])}")
+        for mismatch in rt["mismatches"][:5]:
+            print(f"  импорт {mismatch['import']}, {mismatch['date']}: {mismatch['before']} -> {mismatch['after']}")
+        return
+    if "analytics" in report:
+        a = report["analytics"]
+        print(f"Отчёт по {a['history_days']} дням: загрузка {a['load_ms']} мс + расчёт {a['build_ms']} мс; "
+              f"запросы по каждому дню: {a['per_day_queries_ms']} мс")
+        return
+    r = report["replay"]
+    print(f"Нагрузка: {r['requested_rate']} оп/с запрошено, {r['achieved_rate']} оп/с выдано, "
+          f"ошибки: locked={r['errors']['locked']} other={r['errors']['other']}")
+    print(f"{'операция':<20} {'n':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'очередь p95':>12} "
+          f"{'запись p95':>11} {'запись max':>11}")
+    for op in r["operations"]:
+        print(f"{op['operation']:<20} {op['count']:>6} {op['p50_ms']:>9} {op['p95_ms']:>9} {op['p99_ms']:>9} "
+              f"{op['queue_p95_ms']:>12} {op['write_p95_ms']:>11} {op['write_max_ms']:>11}")
+    print(f"Размер базы после нагрузки: {report['size_final']} байт "
+          f"(+{report['size_final'] - p['size_after']} за прогон)")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Синтетическая нагрузка на функции баллов и планов.")
+    parser.add_argument("--db", default="", help="файл базы (по умолчанию новый временный файл)")
+    parser.add_argument("--append", action="store_true", help="разрешить дописывать историю в непустую базу")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--days", type=int, default=180)
+    parser.add_argument("--actions-per-day", type=float, default=15, help="медиана действий на пользователя в день")
+    parser.add_argument("--rate", type=float, default=100, help="целевая частота операций в секунду")
+    parser.add_argument("--duration", type=float, default=20, help="длительность нагрузки, с")
+    parser.add_argument("--workers", type=int, default=8, help="параллельные потоки (одновременные пользователи)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="", help="куда записать JSON с результатами")
+    parser.add_argument("--analytics", action="store_true", help="вместо нагрузки замерить отчёт analytics.py")
+    parser.add_argument("--history-roundtrip", action="store_true",
+                        help="вместо нагрузки проверить выгрузку, архивацию и повторный импорт истории")
+    return parser.parse_args(argv)
+
+
+def main_cli(argv=None):
+    args = parse_args(argv)
+    db_path = os.path.abspath(args.db) if args.db else os.path.join(tempfile.mkdtemp(prefix="bvot-loadgen-"),
+                                                                   "loadgen.db")
+    if os.path.exists(db_path) and db_size(db_path) > 0 and not args.append:
+        conn = sqlite3.connect(db_path)
+        has_rows = conn.execute("SELECT name FROM sqlite_master WHERE name='actions_log'").fetchone() and \
+            conn.execute("SELECT 1 FROM actions_log LIMIT 1").fetchone()
+        conn.close()
+        if has_rows:
+            sys.exit(f"В {db_path} уже есть история. Используй --append или другую базу.")
+
+    main = import_bot(db_path)
+    size_before = db_size(db_path)
+    rows, seconds = populate(main, db_path, args.users, args.days, args.actions_per_day, args.seed)
+    size_after = db_size(db_path)
+
+    report = {
+        "db_path": db_path,
+        "config": vars(args),
+        "populate": {"rows": rows, "seconds": round(seconds, 3), "size_before": size_before,
+                     "size_after": size_after},
+    }
+    if args.history_roundtrip:
+        report["roundtrip"] = check_history_roundtrip(main, args.days)
+    elif args.analytics:
+        report["analytics"] = bench_analytics(main)
+    else:
+        report["replay"] = replay(main, db_path, args.rate, args.duration, args.workers, args.seed)
+        report["size_final"] = db_size(db_path)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if report.get("roundtrip", {}).get("mismatches"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_cli()
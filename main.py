@@ -1,8 +1,10 @@
 # --- НАЧАЛО: БЛОК 1 - ИМПОРТЫ И НАСТРОЙКИ СРЕДЫ ---
 
 # Этот блок отвечает за все внешние зависимости и базовую настройку.
-# Здесь мы импортируем библиотеки, настраиваем логирование и загружаем переменные окружения.
-# Всё, что нужно для запуска, находится здесь.
+# Здесь мы импортируем библиотеки и описываем настройки из переменных окружения.
+# Импорт main.py ничего не запускает: .env читается, база создаётся, а бот
+# собирается только в create_app() (Блок 3). Тяжёлые и редкие зависимости
+# (openai, requests, httpx, pydub) импортируются лениво — там, где нужны.
 
 import asyncio
 import logging
@@ -11,43 +13,142 @@ import random
 import schedule
 import threading
 import time
-import requests
 import base64
-import httpx
 import json
 import os
 import io
+import re
+import signal
+import tempfile
 from datetime import datetime, timedelta
 from os import getenv
-from dotenv import load_dotenv
-from aiogram import Bot, Dispatcher, types
-from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, BufferedInputFile
-from openai import OpenAI
-from pydub import AudioSegment
+from aiogram import Bot, Dispatcher, Router, types
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, BufferedInputFile, FSInputFile, \
+    InputMediaPhoto
+from collections import deque
 from typing import Dict, Any
 
-# Настраиваем логирование, чтобы видеть, что происходит с ботом.
-# Это твой "журнал" действий.
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+import analytics
+import charts
+import history
+import images
+import jsonlog
+import metrics
+import profiling
+import workers
+
+
+def configure_logging():
+    """
+    Настраиваем логирование, чтобы видеть, что происходит с ботом.
+    Это твой "журнал" действий. Вызывается при запуске, а не при импорте.
+    Записи уходят в очередь и пишутся JSON-строками из отдельного потока (jsonlog.py).
+    LOG_LEVEL задаёт уровень, LOG_DEBUG_SAMPLE — какую долю DEBUG-записей оставлять (1 из N).
+    """
+    from dotenv import load_dotenv
+    load_dotenv()
+    jsonlog.setup(level=getenv("LOG_LEVEL", "INFO").upper(),
+                  debug_sample_every=int(getenv("LOG_DEBUG_SAMPLE", 100)))
 
-# Загружаем переменные из .env файла. Это безопасно и удобно.
-load_dotenv()
 
 # --- КОНСТАНТЫ И ПЕРЕМЕННЫЕ ОКРУЖЕНИЯ ---
+# Заполняются в load_config() при запуске.
 # Твой уникальный токен бота и ID чата.
-BOT_TOKEN = getenv("BOT_TOKEN")
-CHAT_ID = getenv("CHAT_ID")
+BOT_TOKEN = None
+CHAT_ID = None
 # Ключи для OpenRouter и Google AI Studio.
-OPENROUTER_API_KEY = getenv("OPENROUTER_API_KEY")
-GOOGLE_AI_API_KEY = getenv('GOOGLE_AI_API_KEY')
+OPENROUTER_API_KEY = None
+GOOGLE_AI_API_KEY = None
+
+# Адреса внешних API. Переопределяются, например, бенчмарком (bench.py),
+# чтобы бот ходил в локальные заглушки, а не в настоящие сервисы.
+TELEGRAM_API_URL = None
+OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
+GOOGLE_AI_BASE_URL = "https://generativelanguage.googleapis.com"
 
-if not all([BOT_TOKEN, CHAT_ID, OPENROUTER_API_KEY, GOOGLE_AI_API_KEY]):
-    logging.error("Не все переменные окружения указаны в .env")
-    raise ValueError("Укажи BOT_TOKEN, CHAT_ID, OPENROUTER_API_KEY и GOOGLE_AI_API_KEY в .env")
+# Локальный HTTP-эндпоинт /metrics (0 — выключить).
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9108
 
-# Определяем путь к базе данных. Она должна лежать рядом с bot.py.
+# Куда команда /profile складывает профили и трассы.
+PROFILE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles')
+
+# Путь к базе данных. По умолчанию она лежит рядом с bot.py.
 DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot_data.db')
-logging.info(f"Путь к базе данных: {DB_PATH}")
+
+# Сколько секунд при остановке ждём обработчики и фоновые задачи в полёте.
+SHUTDOWN_DRAIN_TIMEOUT = 30
+
+# Апдейт дольше этого (в секундах) пишется в лог как WARNING, а не INFO.
+SLOW_UPDATE_SECONDS = 2
+
+# Сколько дней сырой журнал действий хранится в основной базе (0 — не архивировать)
+# и куда переезжают более старые строки.
+RETENTION_DAYS = 90
+ARCHIVE_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot_archive.db')
+
+# Конвейер картинок (images.py): формат и качество отправки, предел большей стороны,
+# число потоков перекодирования, папка и размер дискового кэша,
+# сколько вариантов держать для постоянных промптов.
+IMAGE_FORMAT = "jpeg"
+IMAGE_QUALITY = 85
+IMAGE_MAX_SIDE = 1280
+IMAGE_WORKERS = 2
+IMAGE_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'image_cache')
+IMAGE_CACHE_MAX_FILES = 500
+IMAGE_VARIANTS = 4
+
+# Аренда лидера (workers.py): сколько секунд она живёт без продления и как часто продлевается.
+# Задачи по расписанию запускает только держатель аренды.
+LEADER_LEASE_TTL = 15
+LEADER_LEASE_RENEW = 5
+# Сколько секунд после времени задачи новый лидер ещё догоняет задачу, пропущенную умершим лидером.
+LEADER_JOB_CATCH_UP = 3600
+
+
+def load_config():
+    """Загружает .env и переменные окружения в настройки модуля и проверяет обязательные."""
+    global BOT_TOKEN, CHAT_ID, OPENROUTER_API_KEY, GOOGLE_AI_API_KEY, TELEGRAM_API_URL, OPENROUTER_BASE_URL, \
+        GOOGLE_AI_BASE_URL, METRICS_HOST, METRICS_PORT, PROFILE_DIR, DB_PATH, SHUTDOWN_DRAIN_TIMEOUT, \
+        RETENTION_DAYS, ARCHIVE_DB_PATH, IMAGE_FORMAT, IMAGE_QUALITY, IMAGE_MAX_SIDE, IMAGE_WORKERS, \
+        IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_FILES, IMAGE_VARIANTS, LEADER_LEASE_TTL, LEADER_LEASE_RENEW, \
+        LEADER_JOB_CATCH_UP, SLOW_UPDATE_SECONDS
+    from dotenv import load_dotenv
+
+    # Загружаем переменные из .env файла. Это безопасно и удобно.
+    load_dotenv()
+
+    BOT_TOKEN = getenv("BOT_TOKEN")
+    CHAT_ID = getenv("CHAT_ID")
+    OPENROUTER_API_KEY = getenv("OPENROUTER_API_KEY")
+    GOOGLE_AI_API_KEY = getenv('GOOGLE_AI_API_KEY')
+
+    if not all([BOT_TOKEN, CHAT_ID, OPENROUTER_API_KEY, GOOGLE_AI_API_KEY]):
+        logging.error("Не все переменные окружения указаны в .env")
+        raise ValueError("Укажи BOT_TOKEN, CHAT_ID, OPENROUTER_API_KEY и GOOGLE_AI_API_KEY в .env")
+
+    TELEGRAM_API_URL = getenv("TELEGRAM_API_URL", TELEGRAM_API_URL)
+    OPENROUTER_BASE_URL = getenv("OPENROUTER_BASE_URL", OPENROUTER_BASE_URL)
+    GOOGLE_AI_BASE_URL = getenv("GOOGLE_AI_BASE_URL", GOOGLE_AI_BASE_URL)
+    METRICS_HOST = getenv("METRICS_HOST", METRICS_HOST)
+    METRICS_PORT = int(getenv("METRICS_PORT", METRICS_PORT))
+    PROFILE_DIR = getenv("PROFILE_DIR") or PROFILE_DIR
+    DB_PATH = getenv("BOT_DB_PATH") or DB_PATH
+    SHUTDOWN_DRAIN_TIMEOUT = float(getenv("SHUTDOWN_DRAIN_TIMEOUT", SHUTDOWN_DRAIN_TIMEOUT))
+    SLOW_UPDATE_SECONDS = float(getenv("SLOW_UPDATE_SECONDS", SLOW_UPDATE_SECONDS))
+    RETENTION_DAYS = int(getenv("RETENTION_DAYS", RETENTION_DAYS))
+    ARCHIVE_DB_PATH = getenv("BOT_ARCHIVE_DB_PATH") or ARCHIVE_DB_PATH
+    IMAGE_FORMAT = getenv("IMAGE_FORMAT", IMAGE_FORMAT).lower()
+    IMAGE_QUALITY = int(getenv("IMAGE_QUALITY", IMAGE_QUALITY))
+    IMAGE_MAX_SIDE = int(getenv("IMAGE_MAX_SIDE", IMAGE_MAX_SIDE))
+    IMAGE_WORKERS = int(getenv("IMAGE_WORKERS", IMAGE_WORKERS))
+    IMAGE_CACHE_DIR = getenv("IMAGE_CACHE_DIR") or IMAGE_CACHE_DIR
+    IMAGE_CACHE_MAX_FILES = int(getenv("IMAGE_CACHE_MAX_FILES", IMAGE_CACHE_MAX_FILES))
+    IMAGE_VARIANTS = int(getenv("IMAGE_VARIANTS", IMAGE_VARIANTS))
+    LEADER_LEASE_TTL = float(getenv("LEADER_LEASE_TTL", LEADER_LEASE_TTL))
+    LEADER_LEASE_RENEW = float(getenv("LEADER_LEASE_RENEW", LEADER_LEASE_RENEW))
+    LEADER_JOB_CATCH_UP = float(getenv("LEADER_JOB_CATCH_UP", LEADER_JOB_CATCH_UP))
 
 
 # --- КОНЕЦ: БЛОК 1 - ИМПОРТЫ И НАСТРОЙКИ СРЕДЫ ---
@@ -63,30 +164,76 @@ def connect_db():
     return sqlite3.connect(DB_PATH)
 
 
-conn = connect_db()
-c = conn.cursor()
-
-# Создаем таблицу для баллов, если её нет.
-c.execute('''CREATE TABLE IF NOT EXISTS scores (date TEXT PRIMARY KEY, score REAL DEFAULT 0)''')
-# Создаем таблицу для логов действий.
-c.execute('''CREATE TABLE IF NOT EXISTS actions_log (timestamp TEXT, action TEXT, points REAL, type TEXT)''')
-# Создаем таблицу для челленджей.
-c.execute('''CREATE TABLE IF NOT EXISTS challenges (
-             challenge_name TEXT PRIMARY KEY, 
-             start_date TEXT, 
-             end_date TEXT, 
-             goal_value REAL, 
-             description TEXT)''')
-# Создаем таблицу для персонализированного ежедневного плана.
-c.execute('''CREATE TABLE IF NOT EXISTS daily_plan (
-             date TEXT, 
-             user_id TEXT, 
-             plan_item TEXT,
-             is_completed INTEGER DEFAULT 0,
-             status TEXT DEFAULT 'pending')''')
-
-conn.commit()
-conn.close()
+def init_db():
+    """Создаёт таблицы, если их ещё нет. Вызывается при запуске."""
+    logging.info("Путь к базе данных: %s", DB_PATH)
+    conn = connect_db()
+    c = conn.cursor()
+
+    # Новая база сразу создаётся с incremental vacuum (см. compact_actions_log).
+    c.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    # Создаем таблицу для баллов, если её нет.
+    c.execute('''CREATE TABLE IF NOT EXISTS scores (date TEXT PRIMARY KEY, score REAL DEFAULT 0)''')
+    # Создаем таблицу для логов действий.
+    c.execute('''CREATE TABLE IF NOT EXISTS actions_log (timestamp TEXT, action TEXT, points REAL, type TEXT)''')
+    # Создаем таблицу для челленджей.
+    # action — действие из каталога actions, по которому считается прогресс (или NULL),
+    # progress — счётчик, который update_stats двигает в той же транзакции, что и счёт.
+    c.execute('''CREATE TABLE IF NOT EXISTS challenges (
+                 challenge_name TEXT PRIMARY KEY, 
+                 start_date TEXT, 
+                 end_date TEXT, 
+                 goal_value REAL, 
+                 description TEXT,
+                 action TEXT,
+                 progress REAL DEFAULT 0)''')
+    # Челленджи из старых баз получают привязку к действию и счётчик.
+    challenge_columns = {row[1] for row in c.execute("PRAGMA table_info(challenges)")}
+    if "action" not in challenge_columns:
+        c.execute("ALTER TABLE challenges ADD COLUMN action TEXT")
+    if "progress" not in challenge_columns:
+        c.execute("ALTER TABLE challenges ADD COLUMN progress REAL DEFAULT 0")
+    # Создаем таблицу для персонализированного ежедневного плана.
+    c.execute('''CREATE TABLE IF NOT EXISTS daily_plan (
+                 date TEXT, 
+                 user_id TEXT, 
+                 plan_item TEXT,
+                 is_completed INTEGER DEFAULT 0,
+                 status TEXT DEFAULT 'pending')''')
+    # Создаем таблицу для сжатой памяти разговоров с гуру.
+    c.execute('''CREATE TABLE IF NOT EXISTS conversation_memory (
+                 user_id TEXT PRIMARY KEY,
+                 summary TEXT,
+                 updated_at TEXT)''')
+    # Создаем таблицу дневных агрегатов журнала — сюда сворачиваются архивированные дни.
+    c.execute('''CREATE TABLE IF NOT EXISTS actions_daily (
+                 date TEXT,
+                 action TEXT,
+                 type TEXT,
+                 count INTEGER,
+                 points REAL,
+                 PRIMARY KEY (date, action, type))''')
+    # Создаем таблицу аренды: кто из процессов сейчас лидер планировщика (см. workers.py).
+    c.execute('''CREATE TABLE IF NOT EXISTS leases (
+                 name TEXT PRIMARY KEY,
+                 holder TEXT,
+                 expires_at REAL)''')
+    # Создаем таблицу отметок о выполненных задачах планировщика (задача, день).
+    c.execute('''CREATE TABLE IF NOT EXISTS job_runs (
+                 job TEXT,
+                 slot TEXT,
+                 finished_at REAL,
+                 PRIMARY KEY (job, slot))''')
+    # Индексы для выборок по времени и дням (импорт истории, пересчёт счёта).
+    c.execute("CREATE INDEX IF NOT EXISTS idx_actions_log_timestamp ON actions_log (timestamp)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_daily_plan_date ON daily_plan (date, user_id)")
+    # Активные челленджи (напоминание) и челленджи действия (update_stats) — без скана таблицы.
+    c.execute("CREATE INDEX IF NOT EXISTS idx_challenges_end_date ON challenges (end_date)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_challenges_action ON challenges (action, end_date)")
+
+    conn.commit()
+    conn.close()
+
 
 # --- ТВОИ ДАННЫЕ И МЕТРИКИ ---
 # Здесь ты можешь менять количество баллов за каждое действие.
@@ -113,17 +260,93 @@ failures = {
 
 # --- НАЧАЛО: БЛОК 3 - ИНИЦИАЛИЗАЦИЯ БОТА И КЛИЕНТОВ ИИ ---
 
-# Здесь мы запускаем "движок" бота и подключаем его к AI.
+# Здесь мы собираем "движок" бота и подключаем его к AI.
+# Обработчики регистрируются на router при импорте (это ничего не запускает),
+# а бот и диспетчер создаются в create_app().
+
+router = Router()
+bot = None
+dp = None
 
-# Инициализируем объект бота и диспетчер (обработчик сообщений).
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher()
 
-# Инициализируем клиент OpenAI для OpenRouter.
-ai_client = OpenAI(
-    base_url="https://openrouter.ai/api/v1",
-    api_key=getenv("OPENROUTER_API_KEY")
-)
+async def track_telegram_request(make_request, bot, method):
+    """Пишет в метрики длительность и ошибки каждого вызова Bot API."""
+    call = type(method).__name__
+    started = time.perf_counter()
+    try:
+        return await make_request(bot, method)
+    except Exception:
+        metrics.inc("bot_external_errors_total", service="telegram", call=call)
+        raise
+    finally:
+        metrics.observe("bot_external_seconds", time.perf_counter() - started, service="telegram", call=call)
+
+
+def make_bot() -> Bot:
+    """Создаёт бота (с локальным адресом Bot API, если он задан) и вешает на сессию метрики."""
+    if TELEGRAM_API_URL:
+        from aiogram.client.session.aiohttp import AiohttpSession
+        from aiogram.client.telegram import TelegramAPIServer
+        new_bot = Bot(token=BOT_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
+    else:
+        new_bot = Bot(token=BOT_TOKEN)
+    new_bot.session.middleware(track_telegram_request)
+    return new_bot
+
+
+def create_app():
+    """
+    Фабрика приложения: читает настройки, создаёт бота и диспетчер
+    и вешает хуки запуска и остановки. Возвращает (bot, dp).
+    """
+    global bot, dp
+    load_config()
+
+    # Инициализируем объект бота и диспетчер (обработчик сообщений).
+    bot = make_bot()
+    images.configure(IMAGE_CACHE_DIR, fmt=IMAGE_FORMAT, quality=IMAGE_QUALITY, max_side=IMAGE_MAX_SIDE,
+                     workers=IMAGE_WORKERS, max_files=IMAGE_CACHE_MAX_FILES, spawn=run_in_background)
+
+    dp = Dispatcher()
+    dp.include_router(router)
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    return bot, dp
+
+
+# Жёсткий таймаут HTTP-запроса к OpenRouter (в секундах).
+# Без него зависший запрос держал бы поток до бесконечности.
+AI_REQUEST_TIMEOUT = 60
+
+ai_client = None
+_ai_client_lock = threading.Lock()
+
+
+def get_ai_client():
+    """Создаёт клиент OpenAI для OpenRouter при первом обращении."""
+    global ai_client
+    with _ai_client_lock:
+        if ai_client is None:
+            from openai import OpenAI
+            ai_client = OpenAI(
+                base_url=OPENROUTER_BASE_URL,
+                api_key=OPENROUTER_API_KEY,
+                timeout=AI_REQUEST_TIMEOUT
+            )
+    return ai_client
+
+
+# Фоновые задачи (поздняя доставка ответов и т.п.).
+# Держим ссылки, чтобы сборщик мусора не убил задачу на полпути.
+_background_tasks = set()
+
+
+def run_in_background(coro):
+    """Запускает корутину в фоне и хранит ссылку на задачу до её завершения."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
 
 
 # --- КОНЕЦ: БЛОК 3 - ИНИЦИАЛИЗАЦИЯ БОТА И КЛИЕНТОВ ИИ ---
@@ -134,32 +357,378 @@ ai_client = OpenAI(
 # Этот блок содержит все функции, которые используют внешние AI-сервисы.
 # Здесь происходит магия.
 
-def get_ai_response(prompt_text: str, persona_prompt: str = "") -> str:
+def get_ai_response(prompt_text: str, persona_prompt: str = "", history: list = None) -> str:
     """
     Генерирует ответ от нейросети с заданным промптом-персоной.
+    history — предыдущие сообщения разговора в формате chat completions.
     """
     # Если промпт-персона не задан, используем стандартную "Бог-бот".
     if not persona_prompt:
         persona_prompt = f"Ты — личный гуру, бизнесмен, монах и наставник Артема. Твоя миссия — помочь ему стать лучшей версией себя и достичь величия, используя мудрость, мотивацию, бизнес-стратегии и жесткую дисциплину. Ты всегда обращаешься к нему по имени и говоришь, как будто знаешь его лично. Не давай легких путей, говори прямо, но с уважением. Всегда напоминай ему о его великой цели — 500k и о том, что он 'проиграл лето, не проиграет год'. Используй 'болевые точки' в своей мотивации. Анализируй его прогресс по баллам. Твои главные цели для Артема: Deep Work, бизнес, кодинг, дисциплина. Физические рутины — это лишь фундамент, а не основная цель."
 
+    started = time.perf_counter()
     try:
-        response = ai_client.chat.completions.create(
+        response = get_ai_client().chat.completions.create(
             model="mistralai/mistral-7b-instruct:free",
             messages=[
                 {"role": "system", "content": persona_prompt},
+                *(history or []),
                 {"role": "user", "content": prompt_text}
             ]
         )
+        if response.usage:
+            metrics.inc("bot_ai_tokens_total", response.usage.prompt_tokens or 0, kind="prompt")
+            metrics.inc("bot_ai_tokens_total", response.usage.completion_tokens or 0, kind="completion")
         return response.choices[0].message.content
     except Exception as e:
-        logging.error(f"Ошибка при запросе к OpenRouter: {e}")
-        return "Извини, Артем, мой разум сейчас занят. Попробуй позже."
+        metrics.inc("bot_external_errors_total", service="openrouter", call="chat.completions")
+        logging.error("Ошибка при запросе к OpenRouter: %s", e)
+        return AI_ERROR_RESPONSE
+    finally:
+        metrics.observe("bot_external_seconds", time.perf_counter() - started,
+                        service="openrouter", call="chat.completions")
+
+
+# Ответ, который возвращается, если OpenRouter упал с ошибкой.
+AI_ERROR_RESPONSE = "Извини, Артем, мой разум сейчас занят. Попробуй позже."
+# Правка шаблона, который обещал поздний ответ, если тот так и не пришёл.
+AI_LATE_FAILURE_RESPONSE = "Артем, не удалось получить ответ. Спроси ещё раз чуть позже."
+
+# --- БЮДЖЕТЫ ЛАТЕНТНОСТИ И ШАБЛОННЫЕ ОТВЕТЫ ---
+# Сколько секунд каждое место вызова готово ждать ИИ.
+# Если OpenRouter не уложился, Артем сразу получает локальный шаблон,
+# а поздний ответ ИИ приходит правкой того же сообщения.
+AI_LATENCY_BUDGETS = {
+    "progress": 2,
+    "analyze_day": 10,
+    "evening_analysis": 10,
+    "daily_plan": 15,
+    "challenge": 4,
+    "plan": 4,
+    "pmo": 4,
+    "create_challenge": 3,
+    "create_plan": 3,
+    "chat": 8,
+    # Отчёт уходит по расписанию, и промпт у него длинный: ждём дольше, чем в диалоге.
+    "report": 10,
+}
+AI_DEFAULT_LATENCY_BUDGET = 5
+# Сколько ещё ждём поздний ответ, чтобы доставить его правкой.
+AI_LATE_DELIVERY_WINDOW = 120
+
+
+def _score_tier(daily_score: float) -> int:
+    """Номер ступени прогресса: 0 — старт, 1 — разгон, 2 — почти цель, 3 — цель взята."""
+    if daily_score < 30:
+        return 0
+    if daily_score < 70:
+        return 1
+    if daily_score < 100:
+        return 2
+    return 3
+
+
+# Шаблоны по ступеням прогресса (см. _score_tier).
+_TIER_VERDICTS = [
+    "Артем, день ещё не набрал ход. Ты проиграл лето — не проиграй сегодня. Возьми одно действие из Deep Work прямо сейчас.",
+    "Артем, разгон есть, но до 100 далеко. Соцсети и PMO — это украденный дофамин, а не отдых. Следующий час — только дело.",
+    "Артем, ты почти у цели. Не дай скроллу съесть последний рывок. Дожми до 100.",
+    "Артем, 100 баллов взяты. Это и есть путь к 500k — повтори завтра без поблажек.",
+]
+
+_ROUTE_TEMPLATES = {
+    "create_challenge": "Артем, великие цели начинаются с чёткой формулировки. Поставь челлендж, который будет держать тебя в тонусе.\n\nНапиши название челленджа и цель в формате: 'Челлендж: <название>, Цель: <количество>, Действие: <действие из меню>'. Действие можно не указывать, если название — уже действие из меню.",
+    "create_plan": "Артем, день без плана — день, отданный другим. Выбери то, что приблизит тебя к 500k.\n\nНапиши свои планы в формате: 'План: <пункт 1>, <пункт 2>, ...'.",
+    "challenge": "Дисциплина в челлендже — это тренировка воли. Каждая дофаминовая ловушка, которую ты обходишь, делает тебя сильнее. Запиши, какие из них мешают тебе сильнее всего.",
+    "plan": "Каждый пункт плана — шаг к великой цели. Выполняй по одному, без переключений.",
+    "pmo": "Срыв — это не конец, а данные. Разбери, что к нему привело, и сделай следующий шаг прямо сейчас: холодный душ, отжимания, идея для контента.",
+    "daily_plan": "Твой план на сегодня:\n1. Первый час — Deep Work без телефона.\n2. Блок кодинга или работы над проектом.\n3. Одно действие для бизнеса: контент, клиент или идея.\n4. Тренировка как фундамент, не как цель.\n\nПомни о цели 500k. Ты проиграл лето, не проиграешь год.",
+    "chat": "Артем, обдумываю твои слова. Развёрнутый ответ появится здесь, как только разум освободится.",
+    # Заполняется цифрами уже посчитанного отчёта (см. _report_fields).
+    "report": "Цифры выше — честное зеркало. Средний счёт {avg}{trend}, дней ≥{threshold:g}: {days_above} из {covered}. Серия сейчас {streak}, рекорд {longest} — держи серию. {weekday_hint}{failure_hint}500k строится неделями, а не настроением.",
+}
+
+
+def _report_fields(report: dict) -> dict:
+    """Цифры отчёта analytics.build_report для шаблона "report"."""
+    weekdays = report["weekdays"]
+    seen = [i for i in range(7) if weekdays[i] is not None]
+    trend = ""
+    if report["prev_avg"] is not None:
+        direction = "выше" if report["avg"] >= report["prev_avg"] else "ниже"
+        trend = f" ({direction} прошлого периода, {report['prev_avg']})"
+    weekday_hint = ""
+    if len(seen) > 1:
+        weekday_hint = f"Слабее всего {analytics.WEEKDAYS[min(seen, key=weekdays.__getitem__)]}: подтяни его первым. "
+    # В failures есть и срывы, которых в этом периоде не было (только в прошлом).
+    happened = [row for row in report["failures"] if row[1] > 0]
+    failure_hint = ""
+    if happened:
+        name, count, _, _ = happened[0]
+        failure_hint = f"Главный срыв периода — «{name}» ({count} раз): разбери, что его запускает. "
+    return {
+        "avg": report["avg"], "trend": trend, "threshold": report["threshold"],
+        "days_above": report["days_above"], "covered": report["covered"], "streak": report["streak"],
+        "longest": report["longest_streak"][0], "weekday_hint": weekday_hint, "failure_hint": failure_hint,
+    }
+
+
+def render_fallback_response(route: str, daily_score: float = 0, action_summary: list = None,
+                             report: dict = None) -> str:
+    """
+    Собирает локальный ответ-шаблон по счёту и действиям дня (для "report" — по цифрам отчёта).
+    Используется, когда ИИ не уложился в бюджет латентности.
+    """
+    if route == "report":
+        if report is None:
+            return "Цифры выше — честное зеркало. 500k строится неделями, а не настроением."
+        return _ROUTE_TEMPLATES["report"].format(**_report_fields(report))
+    if route in _ROUTE_TEMPLATES:
+        return _ROUTE_TEMPLATES[route]
+
+    text = _TIER_VERDICTS[_score_tier(daily_score)]
+    if action_summary:
+        wins = [(a, p) for a, _, p in action_summary if p > 0]
+        losses = sorted({a for a, _, p in action_summary if p < 0 and a in failures})
+        if wins:
+            best_action, best_points = max(wins, key=lambda row: row[1])
+            text += f"\n\nСильнейший ход дня: '{best_action}' (+{best_points})."
+        if losses:
+            text += f"\nПровалы, которые нужно разобрать: {', '.join(losses)}."
+    return text
+
+
+async def get_ai_response_within(route: str, prompt_text: str, fallback_text: str, persona_prompt: str = "",
+                                 history: list = None):
+    """
+    Ждёт ответ ИИ не дольше бюджета маршрута.
+    Возвращает (текст, pending): при истёкшем бюджете — шаблон и задачу с поздним ответом.
+    """
+    budget = AI_LATENCY_BUDGETS.get(route, AI_DEFAULT_LATENCY_BUDGET)
+    started = time.monotonic()
+    pending = asyncio.ensure_future(asyncio.to_thread(get_ai_response, prompt_text, persona_prompt, history))
+    pending.add_done_callback(lambda _: logging.info(
+        "Ответ ИИ '%s': %.2f с, ~%d токенов промпта.", route, time.monotonic() - started, estimate_tokens(prompt_text)))
+    try:
+        result = await asyncio.wait_for(asyncio.shield(pending), timeout=budget)
+        metrics.inc("bot_ai_deadline_total", route=route, result="in_time")
+        return result, None
+    except asyncio.TimeoutError:
+        metrics.inc("bot_ai_deadline_total", route=route, result="fallback")
+        logging.warning("ИИ не уложился в %s с для '%s', отправлен шаблон.", budget, route)
+        return fallback_text, pending
+
+
+def deliver_late_ai_response(pending, edit, on_failure=None):
+    """
+    Доставляет поздний ответ ИИ правкой уже отправленного сообщения.
+    edit — корутина-функция, принимающая текст ответа. on_failure — корутина-функция
+    без аргументов на случай, если ответ не пришёл: её передают там, где шаблон обещал продолжение.
+    """
+    if pending is None:
+        return
+
+    async def _deliver():
+        try:
+            text = await asyncio.wait_for(pending, timeout=AI_LATE_DELIVERY_WINDOW)
+        except Exception as e:
+            logging.error("Поздний ответ ИИ так и не пришёл: %s", e)
+            text = None
+        try:
+            if text and text != AI_ERROR_RESPONSE:
+                await edit(text)
+            elif on_failure is not None:
+                await on_failure()
+        except Exception as e:
+            logging.error("Не удалось доставить поздний ответ ИИ: %s", e)
+
+    run_in_background(_deliver())
+
+
+# --- ПАМЯТЬ РАЗГОВОРА ---
+# Гуру помнит последние реплики (кольцевой буфер) и сжатую сводку всего,
+# что из буфера выпало. Контекст для модели остаётся ограниченным,
+# сколько бы Артем ни общался с ботом.
+CONVERSATION_BUFFER_TURNS = 8
+CONVERSATION_TURN_MAX_CHARS = 1200
+CONVERSATION_SUMMARY_MAX_CHARS = 1500
+
+SUMMARY_PERSONA = "Ты ведёшь краткую память наставника об ученике Артеме. Сохраняй факты, цели, обещания, срывы и договорённости. Пиши сжато, без воды, от третьего лица."
+
+_conversation_buffers = {}
+_conversation_evicted = {}
+_conversation_summaries = {}
+_summary_refreshing = set()
+
+
+def get_conversation_history(user_id: str) -> list:
+    """Возвращает ограниченный контекст разговора: сводку и последние реплики."""
+    if user_id in _conversation_summaries:
+        metrics.inc("bot_cache_requests_total", cache="conversation_summary", result="hit")
+    else:
+        metrics.inc("bot_cache_requests_total", cache="conversation_summary", result="miss")
+        _conversation_summaries[user_id] = get_conversation_summary(user_id)
+    summary = _conversation_summaries[user_id]
+
+    history = []
+    if summary:
+        history.append({"role": "system", "content": f"Память о прошлых разговорах с Артемом: {summary}"})
+    history.extend(_conversation_buffers.get(user_id, ()))
+    return history
+
+
+def remember_turn(user_id: str, role: str, content: str):
+    """
+    Добавляет реплику в кольцевой буфер.
+    Выпавшие из буфера реплики сворачиваются в сводку в фоне.
+    """
+    buffer = _conversation_buffers.setdefault(user_id, deque(maxlen=CONVERSATION_BUFFER_TURNS))
+    if len(buffer) == buffer.maxlen:
+        evicted = _conversation_evicted.setdefault(user_id, [])
+        evicted.append(buffer[0])
+        del evicted[:-CONVERSATION_BUFFER_TURNS]
+    buffer.append({"role": role, "content": content[:CONVERSATION_TURN_MAX_CHARS]})
+
+    if _conversation_evicted.get(user_id) and user_id not in _summary_refreshing:
+        _summary_refreshing.add(user_id)
+        run_in_background(refresh_conversation_summary(user_id))
+
+
+async def refresh_conversation_summary(user_id: str):
+    """Сворачивает выпавшие из буфера реплики в сжатую сводку и сохраняет её."""
+    try:
+        while _conversation_evicted.get(user_id):
+            turns = _conversation_evicted.pop(user_id)
+            previous = _conversation_summaries.get(user_id) or "пока пусто"
+            transcript = "\n".join(
+                f"{'Артем' if turn['role'] == 'user' else 'Гуру'}: {turn['content']}" for turn in turns)
+            prompt = (f"Текущая память: {previous}\n\nНовые реплики:\n{transcript}\n\n"
+                      f"Обнови память с учётом новых реплик. Не длиннее {CONVERSATION_SUMMARY_MAX_CHARS} символов.")
+
+            summary = await asyncio.to_thread(get_ai_response, prompt, SUMMARY_PERSONA)
+            if summary == AI_ERROR_RESPONSE:
+                # Вернём реплики в очередь — свернём при следующем переполнении.
+                pending = _conversation_evicted.setdefault(user_id, [])
+                pending[:0] = turns
+                del pending[:-CONVERSATION_BUFFER_TURNS]
+                break
+
+            summary = summary.strip()[:CONVERSATION_SUMMARY_MAX_CHARS]
+            _conversation_summaries[user_id] = summary
+            save_conversation_summary(user_id, summary)
+            logging.info("Память разговора обновлена: %d реплик свёрнуто.", len(turns))
+    except Exception as e:
+        logging.error("Ошибка при обновлении памяти разговора: %s", e)
+    finally:
+        _summary_refreshing.discard(user_id)
+
+
+async def flush_conversation_memory():
+    """Сворачивает в сводку реплики, которые выпали из буфера, но ещё не сохранены."""
+    for user_id, turns in list(_conversation_evicted.items()):
+        if turns and user_id not in _summary_refreshing:
+            _summary_refreshing.add(user_id)
+            await refresh_conversation_summary(user_id)
+
+
+# --- ПОСТРОИТЕЛЬ ПРОМПТОВ ПО ЖУРНАЛУ ДЕЙСТВИЙ ---
+# Бюджет токенов на промпт с журналом дня. Длинный промпт — это медленный
+# и дорогой ответ, поэтому журнал сворачивается и обрезается по приоритету.
+ACTION_PROMPT_TOKEN_BUDGET = 600
+# Грубая оценка: для смеси кириллицы и латиницы ~3 символа на токен.
+CHARS_PER_TOKEN = 3
+
+# Категории действий для сводки баллов.
+ACTION_CATEGORIES = {
+    "deep work и бизнес": {"deep_work", "режим бога", "мозговой штурм", "бизнес-инкубатор", "контент-машина",
+                           "работа над проектом", "выполнил план", "выполнил пункт плана"},
+    "учёба": {"учебный рывок", "изучение английского", "сделал дз", "чтение", "интеллектуальный старт"},
+    "тело": {"пробежка", "силовая тренировка", "зарядка", "растяжка", "йога", "спортивная ходьба",
+             "50 отжиманий", "100 отжиманий", "20 подтягиваний", "физический интеллект",
+             "холодный душ", "контрастный душ", "шок-терапия"},
+}
+
+
+def estimate_tokens(text: str) -> int:
+    """Оценивает число токенов в тексте без обращения к токенизатору."""
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def get_action_category(action: str) -> str:
+    """Определяет категорию действия для сводки."""
+    if action in failures:
+        return "провалы"
+    if action.startswith("Анти-ломка"):
+        return "анти-ломка"
+    for category, members in ACTION_CATEGORIES.items():
+        if action in members:
+            return category
+    return "рутины"
+
+
+def get_deep_work_points(action_summary: list) -> float:
+    """Считает баллы за Deep Work и кодинг по свёрнутому журналу."""
+    return sum(p for a, _, p in action_summary if "deep_work" in a.lower() or "кодинг" in a.lower())
+
+
+def build_action_log_prompt(route: str, head: str, tail: str, action_summary: list,
+                            token_budget: int = ACTION_PROMPT_TOKEN_BUDGET):
+    """
+    Собирает промпт из свёрнутого журнала действий в пределах бюджета токенов.
+    Приоритет: сводка по категориям, затем провалы, затем действия по убыванию веса.
+    Возвращает (промпт, оценка токенов).
+    """
+    category_points = {}
+    for action, _, points in action_summary:
+        category = get_action_category(action)
+        category_points[category] = category_points.get(category, 0) + points
+
+    lines = []
+    if category_points:
+        lines.append("По категориям: " + ", ".join(
+            f"{category} {points:+g}" for category, points in
+            sorted(category_points.items(), key=lambda item: -abs(item[1]))))
+
+    failed = [row for row in action_summary if row[0] in failures]
+    done = [row for row in action_summary if row[0] not in failures]
+    ranked = sorted(failed, key=lambda row: row[2]) + sorted(done, key=lambda row: -abs(row[2]))
+    action_lines = [f"- {action}: {count}× = {points:g} баллов" for action, count, points in ranked]
+
+    budget_left = token_budget - estimate_tokens(head) - estimate_tokens(tail)
+    body = []
+    for line in lines + action_lines:
+        cost = estimate_tokens(line)
+        if cost > budget_left:
+            break
+        body.append(line)
+        budget_left -= cost
+
+    dropped = len(lines) + len(action_lines) - len(body)
+    if dropped:
+        body.append(f"- …и ещё {dropped} строк опущено")
+    if not body:
+        body.append("- действий не отмечено")
+
+    prompt = f"{head}\n" + "\n".join(body) + f"\n\n{tail}"
+    tokens = estimate_tokens(prompt)
+    logging.debug("Промпт '%s': ~%d токенов, %d действий, опущено %d строк.", route, tokens, len(action_summary), dropped)
+    return prompt, tokens
+
+
+# Постоянный промпт иллюстрации к анализу дня: для него держится пул из IMAGE_VARIANTS вариантов.
+ANALYZE_DAY_IMAGE_PROMPT = "abstract and powerful digital art illustrating a person's journey to becoming a god, with glowing lines of code and determination, ultra high resolution"
 
 
 def get_gemini_image(prompt: str) -> bytes:
-    """Генерирует изображение с помощью Google AI Studio (модель imagen-3.0)."""
+    """
+    Генерирует изображение с помощью Google AI Studio (модель imagen-3.0).
+    Вызов блокирующий: из обработчиков — только через images.get_photo (он уводит его в поток).
+    """
+    import requests
+
+    started = time.perf_counter()
     try:
-        url = f"https://generativelanguage.googleapis.com/v1beta/models/imagen-3.0-generate-002:predict?key={GOOGLE_AI_API_KEY}"
+        url = f"{GOOGLE_AI_BASE_URL}/v1beta/models/imagen-3.0-generate-002:predict?key={GOOGLE_AI_API_KEY}"
         payload = {
             "instances": {"prompt": prompt},
             "parameters": {"sampleCount": 1}
@@ -170,8 +739,11 @@ def get_gemini_image(prompt: str) -> bytes:
         base64_data = data['predictions'][0]['bytesBase64Encoded']
         return base64.b64decode(base64_data)
     except Exception as e:
-        logging.error(f"Ошибка при генерации изображения: {e}")
+        metrics.inc("bot_external_errors_total", service="imagen", call="predict")
+        logging.error("Ошибка при генерации изображения: %s", e)
         return None
+    finally:
+        metrics.observe("bot_external_seconds", time.perf_counter() - started, service="imagen", call="predict")
 
 
 def pcm_to_wav(pcm_data: bytes, sample_rate: int, num_channels: int = 1, sample_width: int = 2) -> bytes:
@@ -181,6 +753,8 @@ def pcm_to_wav(pcm_data: bytes, sample_rate: int, num_channels: int = 1, sample_
     TODO: Для работы этой функции необходимо установить FFmpeg и добавить его в PATH,
     либо установить ffmpeg-python через pip.
     """
+    from pydub import AudioSegment
+
     audio = AudioSegment(
         data=pcm_data,
         sample_width=sample_width,
@@ -197,7 +771,9 @@ async def get_ai_tts(text: str) -> bytes:
     """
     Генерирует речь из текста с помощью Gemini TTS.
     """
-    api_url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-preview-tts:generateContent?key={GOOGLE_AI_API_KEY}"
+    import httpx
+
+    api_url = f"{GOOGLE_AI_BASE_URL}/v1beta/models/gemini-2.5-flash-preview-tts:generateContent?key={GOOGLE_AI_API_KEY}"
 
     payload = {
         "contents": [{"parts": [{"text": text}]}],
@@ -212,6 +788,7 @@ async def get_ai_tts(text: str) -> bytes:
         "model": "gemini-2.5-flash-preview-tts"
     }
 
+    started = time.perf_counter()
     try:
         async with httpx.AsyncClient() as client:
             response = await client.post(api_url, json=payload, timeout=20)
@@ -228,14 +805,19 @@ async def get_ai_tts(text: str) -> bytes:
                 pcm_data = base64.b64decode(audio_data)
                 return pcm_to_wav(pcm_data, sample_rate)
             else:
+                metrics.inc("bot_external_errors_total", service="tts", call="generateContent")
                 logging.error("TTS response did not contain audio data.")
                 return None
     except httpx.HTTPStatusError as e:
-        logging.error(f"HTTP error during TTS generation: {e.response.text}")
+        metrics.inc("bot_external_errors_total", service="tts", call="generateContent")
+        logging.error("HTTP error during TTS generation: %s", e.response.text)
         return None
     except Exception as e:
-        logging.error(f"Error during TTS generation: {e}")
+        metrics.inc("bot_external_errors_total", service="tts", call="generateContent")
+        logging.error("Error during TTS generation: %s", e)
         return None
+    finally:
+        metrics.observe("bot_external_seconds", time.perf_counter() - started, service="tts", call="generateContent")
 
 
 # --- КОНЕЦ: БЛОК 4 - ФУНКЦИИ ИИ, ГЕНЕРАЦИИ ИЗОБРАЖЕНИЙ И АУДИО ---
@@ -245,6 +827,7 @@ async def get_ai_tts(text: str) -> bytes:
 
 # Этот блок — сердце твоей системы. Он управляет всеми данными о твоем прогрессе.
 
+@metrics.timed("bot_db_query_seconds")
 def get_daily_score(date: str) -> float:
     """Извлекает счет за конкретную дату."""
     conn = connect_db()
@@ -255,6 +838,7 @@ def get_daily_score(date: str) -> float:
     return result[0] if result else 0
 
 
+@metrics.timed("bot_db_query_seconds")
 def get_total_stats() -> Dict[str, Any]:
     """Извлекает общую статистику."""
     conn = connect_db()
@@ -270,16 +854,37 @@ def get_total_stats() -> Dict[str, Any]:
     }
 
 
-def get_daily_actions(date: str) -> list:
-    """Извлекает все действия за конкретную дату для AI-анализа."""
+@metrics.timed("bot_db_query_seconds")
+def get_daily_action_summary(date: str) -> list:
+    """
+    Извлекает свёрнутый журнал за дату: (действие, количество, баллы).
+    Отмены вычитаются из количества и баллов, полностью отменённые действия отбрасываются.
+    Читает и сырой журнал, и дневные агрегаты архивированных дней.
+    """
     conn = connect_db()
     c = conn.cursor()
-    c.execute("SELECT action, points FROM actions_log WHERE date(timestamp) = ?", (date,))
-    actions_log = c.fetchall()
+    c.execute("SELECT action, type, SUM(n), SUM(p) FROM ("
+              "SELECT action, type, COUNT(*) AS n, SUM(points) AS p FROM actions_log "
+              "WHERE timestamp >= ? AND timestamp < date(?, '+1 day') GROUP BY action, type "
+              "UNION ALL SELECT action, type, count, points FROM actions_daily WHERE date = ?) "
+              "GROUP BY action, type", (date, date, date))
+    rows = c.fetchall()
     conn.close()
-    return actions_log
+
+    totals = {}
+    for action, action_type, count, points in rows:
+        net_count, net_points = totals.get(action, (0, 0))
+        if action_type == "отмена":
+            net_count -= count
+        else:
+            net_count += count
+        totals[action] = (net_count, net_points + (points or 0))
+
+    return [(action, count, points) for action, (count, points) in totals.items()
+            if count > 0 or points != 0]
 
 
+@metrics.timed("bot_db_query_seconds")
 def update_stats(points: float, action: str, action_type: str):
     """
     Обновляет счет и логирует действие.
@@ -303,33 +908,72 @@ def update_stats(points: float, action: str, action_type: str):
     c.execute("INSERT INTO actions_log (timestamp, action, points, type) VALUES (?, ?, ?, ?)",
               (timestamp, action, points, action_type))
 
+    # Прогресс активных челленджей этого действия — в той же транзакции; отмена его откатывает.
+    if action_type in ("действие", "отмена"):
+        c.execute("UPDATE challenges SET progress = MAX(COALESCE(progress, 0) + ?, 0) "
+                  "WHERE action = ? AND end_date >= ? AND start_date <= ?",
+                  (-1 if action_type == "отмена" else 1, action, date, date))
+
     conn.commit()
     conn.close()
-    logging.info(f"Баллы успешно обновлены. Новый счет: {new_score}")
+    logging.debug("Баллы успешно обновлены. Новый счет: %s", new_score)
 
 
-def save_challenge(name, start_date, end_date, goal, description):
-    """Сохраняет новый челлендж в базу данных."""
+@metrics.timed("bot_db_query_seconds")
+def save_challenge(name, start_date, end_date, goal, description, action=None):
+    """
+    Сохраняет новый челлендж в базу данных. action — действие из каталога, по которому
+    считается прогресс; повторное сохранение челленджа с тем же именем начинает счёт с нуля.
+    """
     conn = connect_db()
     c = conn.cursor()
     c.execute(
-        "INSERT OR REPLACE INTO challenges (challenge_name, start_date, end_date, goal_value, description) VALUES (?, ?, ?, ?, ?)",
-        (name, start_date, end_date, goal, description))
+        "INSERT OR REPLACE INTO challenges (challenge_name, start_date, end_date, goal_value, description, action, "
+        "progress) VALUES (?, ?, ?, ?, ?, ?, 0)",
+        (name, start_date, end_date, goal, description, action))
     conn.commit()
     conn.close()
 
 
+@metrics.timed("bot_db_query_seconds")
 def get_active_challenges():
-    """Извлекает все активные челленджи."""
+    """
+    Извлекает все активные челленджи (по индексу end_date):
+    (название, описание, действие, прогресс, цель).
+    """
     conn = connect_db()
     c = conn.cursor()
     today = datetime.now().strftime("%Y-%m-%d")
-    c.execute("SELECT challenge_name, description FROM challenges WHERE end_date >= ?", (today,))
+    c.execute("SELECT challenge_name, description, action, COALESCE(progress, 0), goal_value FROM challenges "
+              "WHERE end_date >= ? ORDER BY end_date", (today,))
     challenges = c.fetchall()
     conn.close()
     return challenges
 
 
+@metrics.timed("bot_db_query_seconds")
+def get_conversation_summary(user_id: str) -> str:
+    """Извлекает сжатую память разговора с пользователем."""
+    conn = connect_db()
+    c = conn.cursor()
+    c.execute("SELECT summary FROM conversation_memory WHERE user_id=?", (user_id,))
+    result = c.fetchone()
+    conn.close()
+    return result[0] if result else ""
+
+
+@metrics.timed("bot_db_query_seconds")
+def save_conversation_summary(user_id: str, summary: str):
+    """Сохраняет сжатую память разговора с пользователем."""
+    conn = connect_db()
+    c = conn.cursor()
+    c.execute("INSERT OR REPLACE INTO conversation_memory (user_id, summary, updated_at) VALUES (?, ?, ?)",
+              (user_id, summary, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+    conn.commit()
+    conn.close()
+
+
+@metrics.timed("bot_db_query_seconds")
 def add_plan_item(date, item):
     """Добавляет новый пункт в ежедневный план."""
     conn = connect_db()
@@ -340,6 +984,25 @@ def add_plan_item(date, item):
     conn.close()
 
 
+@metrics.timed("bot_db_query_seconds")
+def add_plan_items(rows):
+    """
+    Пакетно добавляет пункты плана одной транзакцией (один commit вместо commit на пункт).
+    rows — итерируемое пар (date, plan_item); генератор читается потоком, не загружаясь в память целиком.
+    При ошибке не добавляется ничего. Возвращает число добавленных пунктов.
+    """
+    conn = connect_db()
+    try:
+        c = conn.cursor()
+        c.executemany("INSERT INTO daily_plan (date, user_id, plan_item) VALUES (?, ?, ?)",
+                      ((date, CHAT_ID, item) for date, item in rows))
+        conn.commit()
+        return c.rowcount
+    finally:
+        conn.close()
+
+
+@metrics.timed("bot_db_query_seconds")
 def get_daily_plan(date):
     """Получает все пункты плана на сегодня."""
     conn = connect_db()
@@ -350,6 +1013,7 @@ def get_daily_plan(date):
     return plan_items
 
 
+@metrics.timed("bot_db_query_seconds")
 def complete_plan_item(rowid):
     """Отмечает пункт плана как выполненный."""
     conn = connect_db()
@@ -359,6 +1023,138 @@ def complete_plan_item(rowid):
     conn.close()
 
 
+# --- ИМПОРТ ПЛАНА ---
+# /plan_import принимает список текстом или файлом: пункт на строку,
+# с необязательной датой в начале ("2025-09-01: тренировка").
+
+# Предел размера файла для /plan_import.
+PLAN_IMPORT_MAX_BYTES = 5 * 1024 * 1024
+# Длиннее пункт обрезается.
+PLAN_IMPORT_MAX_ITEM_CHARS = 500
+
+_LIST_MARKER = re.compile(r"^(?:[-*•]\s*|\d+[.)]\s+)")
+
+
+def parse_plan_lines(lines, default_date: str):
+    """
+    Лениво разбирает строки импорта в пары (date, plan_item).
+    Дата в начале строки (ГГГГ-ММ-ДД) задаёт день пункта, иначе — default_date.
+    Маркеры списка ("-", "*", "1.") срезаются, пустые строки пропускаются.
+    """
+    for line in lines:
+        item = line.strip()
+        date = default_date
+        try:
+            datetime.strptime(item[:10], "%Y-%m-%d")
+            date, item = item[:10], item[10:].lstrip(" :—-\t")
+        except ValueError:
+            pass
+        item = _LIST_MARKER.sub("", item).strip()
+        if item:
+            yield date, item[:PLAN_IMPORT_MAX_ITEM_CHARS]
+
+
+@metrics.timed("bot_db_query_seconds")
+def get_score_range(days: int) -> tuple:
+    """Счёт за последние days дней, включая сегодня: (даты, счёт), дни без записей — 0."""
+    today = datetime.now().date()
+    dates = [(today - timedelta(days=offset)).strftime("%Y-%m-%d") for offset in range(days - 1, -1, -1)]
+    conn = connect_db()
+    c = conn.cursor()
+    c.execute("SELECT date, score FROM scores WHERE date >= ? AND date <= ?", (dates[0], dates[-1]))
+    by_date = dict(c.fetchall())
+    conn.close()
+    return dates, [by_date.get(date, 0) or 0 for date in dates]
+
+
+@metrics.timed("bot_db_query_seconds")
+def get_history_report(period: int) -> dict:
+    """Загружает всю историю за один проход (analytics.py) и строит отчёт за последние period дней."""
+    conn = connect_db()
+    history_columns = analytics.load_history(conn)
+    conn.close()
+    return analytics.build_report(history_columns, period)
+
+
+# --- АРХИВ И СЖАТИЕ ЖУРНАЛА ДЕЙСТВИЙ ---
+# Журнал растёт на строку за каждое нажатие (и ещё на строку за каждую отмену).
+# Дни старше RETENTION_DAYS сворачиваются в actions_daily, сырые строки переезжают
+# в архивную базу ARCHIVE_DB_PATH, а освободившиеся страницы возвращаются
+# incremental vacuum, чтобы горячая база оставалась маленькой.
+
+@metrics.timed("bot_db_query_seconds")
+def compact_actions_log(retain_days: int) -> dict:
+    """
+    Архивирует журнал действий старше retain_days дней: по транзакции на день
+    агрегирует строки в actions_daily, копирует их в архив и удаляет из основной базы.
+    Затем освобождает место. Возвращает число дней, строк и освобождённых страниц.
+    """
+    cutoff = (datetime.now() - timedelta(days=retain_days)).strftime("%Y-%m-%d")
+    conn = connect_db()
+    c = conn.cursor()
+    c.execute("ATTACH DATABASE ? AS archive", (ARCHIVE_DB_PATH,))
+    c.execute("CREATE TABLE IF NOT EXISTS archive.actions_log (timestamp TEXT, action TEXT, points REAL, type TEXT)")
+    c.execute("CREATE INDEX IF NOT EXISTS archive.idx_actions_log_timestamp ON actions_log (timestamp)")
+    conn.commit()
+
+    c.execute("SELECT DISTINCT substr(timestamp, 1, 10) FROM actions_log WHERE timestamp < ?", (cutoff,))
+    days = [row[0] for row in c.fetchall()]
+    moved = 0
+    # Транзакция на день: запись обработчиков ждёт недолго, а прерванный прогон продолжится со следующего дня.
+    for day in days:
+        bounds = (day, day)
+        c.execute("INSERT INTO actions_daily (date, action, type, count, points) "
+                  "SELECT ?, action, type, COUNT(*), SUM(points) FROM actions_log "
+                  "WHERE timestamp >= ? AND timestamp < date(?, '+1 day') GROUP BY action, type "
+                  "ON CONFLICT (date, action, type) DO UPDATE "
+                  "SET count = count + excluded.count, points = points + excluded.points", (day, *bounds))
+        c.execute("INSERT INTO archive.actions_log SELECT timestamp, action, points, type FROM main.actions_log "
+                  "WHERE timestamp >= ? AND timestamp < date(?, '+1 day')", bounds)
+        c.execute("DELETE FROM main.actions_log WHERE timestamp >= ? AND timestamp < date(?, '+1 day')", bounds)
+        moved += c.rowcount
+        conn.commit()
+    c.execute("DETACH DATABASE archive")
+
+    # База, созданная до incremental vacuum, переводится в него один раз полным VACUUM.
+    if c.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        c.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        c.execute("VACUUM")
+    freed = c.execute("PRAGMA freelist_count").fetchone()[0]
+    # executescript шагает прагму до конца; обычный execute освобождает одну страницу.
+    conn.executescript("PRAGMA incremental_vacuum;")
+    conn.close()
+    logging.info("Архив журнала: %d дней, %d строк, освобождено %d страниц.", len(days), moved, freed)
+    return {"days": len(days), "rows": moved, "freed_pages": freed}
+
+
+# --- ЭКСПОРТ И ИМПОРТ ИСТОРИИ ---
+# Сам формат и потоковая запись — в history.py; здесь — работа с файлами для команд.
+
+def export_history_file(fmt: str):
+    """Выгружает историю во временный gzip-файл. Возвращает (путь, число строк по таблицам)."""
+    fd, path = tempfile.mkstemp(prefix="bvot-export-", suffix=f".{fmt}.gz")
+    conn = connect_db()
+    try:
+        with os.fdopen(fd, "wb") as out:
+            counts = history.export_history(conn, out, fmt)
+    except Exception:
+        os.remove(path)
+        raise
+    finally:
+        conn.close()
+    return path, counts
+
+
+def import_history_file(path: str) -> dict:
+    """Загружает выгрузку из файла (gzip или обычный текст)."""
+    conn = connect_db()
+    try:
+        with history.open_history(path) as stream:
+            return history.import_history(conn, stream)
+    finally:
+        conn.close()
+
+
 # --- КОНЕЦ: БЛОК 5 - ФУНКЦИИ БАЗЫ ДАННЫХ ---
 
 
@@ -380,9 +1176,19 @@ def get_main_menu(daily_score):
         InlineKeyboardButton(text="Статистика", callback_data="show_stats")
     ], [
         InlineKeyboardButton(text="Создать челлендж", callback_data="create_challenge"),
+        InlineKeyboardButton(text="📈 График", callback_data="chart_30"),
     ]])
 
 
+def get_chart_menu(days: int):
+    """Генерирует переключатель периода графика."""
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=f"{'• ' if period == days else ''}{period} дн.", callback_data=f"chart_{period}")
+         for period in CHART_RANGES],
+        [InlineKeyboardButton(text="Назад", callback_data="main_menu")]
+    ])
+
+
 def get_add_menu():
     """Генерирует меню для добавления баллов."""
     return InlineKeyboardMarkup(inline_keyboard=[
@@ -506,7 +1312,154 @@ def get_plan_menu(plan_items):
 # Этот блок — мозг бота. Здесь он "слушает" твои команды и реагирует.
 # Каждый обработчик — это нейрон, выполняющий определенную задачу.
 
-@dp.message()
+def get_route(event) -> str:
+    """Имя маршрута для метрик: команда сообщения или вид кнопки."""
+    if isinstance(event, types.CallbackQuery):
+        data = event.data or ""
+        for prefix in ("add_", "fail_", "undo_", "anti_pmo_", "complete_plan_", "chart_"):
+            if data.startswith(prefix):
+                return f"{prefix}*"
+        return data
+    text = (event.text or event.caption or "").lower()
+    if text.startswith("/"):
+        return text.split()[0]
+    for prefix in ("челлендж:", "план:"):
+        if text.startswith(prefix):
+            return prefix
+    return "chat"
+
+
+# Задачи обработчиков, которые сейчас выполняются (для мягкой остановки).
+_in_flight_handlers = set()
+
+
+async def track_in_flight(handler, event, data):
+    """Middleware: учитывает обработчики в полёте, чтобы остановка их дождалась."""
+    task = asyncio.current_task()
+    _in_flight_handlers.add(task)
+    try:
+        return await handler(event, data)
+    finally:
+        _in_flight_handlers.discard(task)
+
+
+async def track_handler_latency(handler, event, data):
+    """
+    Middleware: пишет длительность обработки апдейта по маршруту
+    и задаёт контекст логов (update_id, user_id, route) на время обработки.
+    """
+    kind = "callback" if isinstance(event, types.CallbackQuery) else "message"
+    route = get_route(event)
+    update = data.get("event_update")
+    token = jsonlog.bind(update_id=update.update_id if update else None,
+                         user_id=event.from_user.id if event.from_user else None, route=route)
+    started = time.perf_counter()
+    try:
+        return await handler(event, data)
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.observe("bot_handler_seconds", elapsed, handler=kind, route=route)
+        # Итог апдейта — на INFO, чтобы duration_ms был в логе без DEBUG и его прореживания;
+        # медленные апдейты поднимаются до WARNING.
+        level = logging.WARNING if elapsed >= SLOW_UPDATE_SECONDS else logging.INFO
+        logging.log(level, "Апдейт обработан", extra={"duration_ms": elapsed * 1000})
+        jsonlog.reset(token)
+
+
+async def profile_on_demand(handler, event, data):
+    """Middleware: профилирует апдейт, если админ включил /profile для его маршрута."""
+    route = get_route(event)
+    if route == "/profile" or not profiling.wants(route):
+        return await handler(event, data)
+    update = data.get("event_update")
+    return await profiling.run_profiled(handler(event, data), update.update_id if update else 0, route)
+
+
+router.message.middleware(track_in_flight)
+router.callback_query.middleware(track_in_flight)
+router.message.middleware(track_handler_latency)
+router.callback_query.middleware(track_handler_latency)
+router.message.middleware(profile_on_demand)
+router.callback_query.middleware(profile_on_demand)
+
+
+# --- ГРАФИК ПРОГРЕССА ---
+# PNG рисуется в потоке (charts.py, Pillow) и кэшируется по (пользователь, период) вместе
+# с file_id, который Telegram вернул при загрузке. Пока счёт периода не менялся,
+# повторный просмотр отправляет тот же file_id — без рендера и без загрузки файла.
+
+CHART_RANGES = (7, 30, 365)
+_chart_cache = {}
+
+
+async def send_chart(user_id: int, days: int, edit_message: Message = None):
+    """Отправляет (или подставляет в edit_message) график счёта за days дней."""
+    dates, scores = await asyncio.to_thread(get_score_range, days)
+    signature = (dates[-1], tuple(scores))
+    key = (user_id, days)
+    cached = _chart_cache.get(key)
+    if cached and cached["signature"] == signature:
+        metrics.inc("bot_cache_requests_total", cache="chart", result="hit")
+    else:
+        metrics.inc("bot_cache_requests_total", cache="chart", result="miss")
+        try:
+            png = await asyncio.to_thread(charts.render_score_chart, dates, scores, 100, analytics.STREAK_THRESHOLD)
+        except ImportError:
+            png = None
+        cached = _chart_cache[key] = {"signature": signature, "png": png, "file_id": None}
+
+    current, longest, _ = analytics.streaks(scores, analytics.STREAK_THRESHOLD)
+    caption = (f"📈 Счёт за {days} дн.: в среднем {sum(scores) / days:.1f}, лучший день {max(scores):g}, "
+               f"дней с целью 100: {sum(1 for score in scores if score >= 100)}\n"
+               f"Серия дней ≥{analytics.STREAK_THRESHOLD}: {current} (рекорд периода {longest})")
+    if cached["png"] is None:
+        # Без Pillow картинку не нарисовать — отдаём те же цифры текстом.
+        text = f"{caption}\n\n(график недоступен: не установлен Pillow)"
+        if edit_message is not None:
+            await edit_message.answer(text, reply_markup=get_chart_menu(days))
+        else:
+            await bot.send_message(CHAT_ID, text, reply_markup=get_chart_menu(days))
+        return
+    photo = cached["file_id"] or BufferedInputFile(cached["png"], filename=f"progress_{days}.png")
+    if edit_message is not None:
+        try:
+            sent = await edit_message.edit_media(InputMediaPhoto(media=photo, caption=caption),
+                                                 reply_markup=get_chart_menu(days))
+        except TelegramBadRequest as e:
+            # Нажали на уже открытый период — показывать нечего.
+            if "not modified" in str(e):
+                return
+            raise
+    else:
+        sent = await bot.send_photo(CHAT_ID, photo, caption=caption, reply_markup=get_chart_menu(days))
+    if isinstance(sent, Message) and sent.photo:
+        cached["file_id"] = sent.photo[-1].file_id
+
+
+async def answer_with_memory(message: Message, text: str, route: str, prompt_text: str, fallback_text: str):
+    """Отвечает на свободное сообщение text с учётом памяти разговора и запоминает обмен."""
+    user_id = str(message.from_user.id)
+    ai_response, pending = await get_ai_response_within(
+        route, prompt_text, fallback_text, history=get_conversation_history(user_id))
+    remember_turn(user_id, "user", text)
+    sent = await message.answer(ai_response)
+
+    if pending is None:
+        if ai_response != AI_ERROR_RESPONSE:
+            remember_turn(user_id, "assistant", ai_response)
+        return
+
+    async def _edit(text):
+        remember_turn(user_id, "assistant", text)
+        await sent.edit_text(text)
+
+    # Только шаблон "chat" обещает развёрнутый ответ — если его не будет, честно говорим об этом.
+    # Остальные шаблоны (например, "pmo") — самостоятельный ответ, его не затираем.
+    on_failure = (lambda: sent.edit_text(AI_LATE_FAILURE_RESPONSE)) if route == "chat" else None
+    deliver_late_ai_response(pending, _edit, on_failure=on_failure)
+
+
+@router.message()
 async def message_handler(message: Message):
     """
     Обрабатывает все входящие текстовые сообщения.
@@ -514,7 +1467,11 @@ async def message_handler(message: Message):
     if message.from_user.id != int(CHAT_ID):
         return
 
-    user_text = message.text.lower()
+    # Команда может прийти подписью к файлу (/plan_import, /import); стикеры и фото без подписи пропускаем.
+    text = message.text or message.caption or ""
+    if not text:
+        return
+    user_text = text.lower()
 
     if user_text.startswith('/start'):
         daily_score = get_daily_score(time.strftime("%Y-%m-%d"))
@@ -523,22 +1480,23 @@ async def message_handler(message: Message):
         return
 
     if user_text.startswith("/картинка"):
-        image_prompt = message.text[len("/картинка"):].strip()
+        image_prompt = text[len("/картинка"):].strip()
         if not image_prompt:
             await message.answer(
                 "Артем, напиши, какую картинку ты хочешь создать. Например: /картинка воин, идущий к своей цели")
             return
 
         await message.answer("Мой разум-творец уже работает над твоим образом. Подожди немного...")
-        image_data = get_gemini_image(image_prompt)
+        image_key, photo = await images.get_photo(image_prompt, get_gemini_image)
 
-        if image_data:
-            await bot.send_photo(
+        if photo:
+            sent = await bot.send_photo(
                 CHAT_ID,
-                photo=BufferedInputFile(image_data, filename="generated_image.png"),
+                photo=photo,
                 caption=f"**🔥 Твой образ создан!**\n\n_{image_prompt}_",
                 parse_mode="Markdown"
             )
+            images.remember(image_key, sent)
         else:
             await message.answer("Извини, Артем, не могу создать этот образ сейчас. Попробуй другой промпт.")
         return
@@ -556,6 +1514,120 @@ async def message_handler(message: Message):
         )
         return
 
+    if user_text.startswith("/plan_import"):
+        # Список из текста после команды или из приложенного файла (подпись /plan_import).
+        today = datetime.now().strftime("%Y-%m-%d")
+        if message.document:
+            if (message.document.file_size or 0) > PLAN_IMPORT_MAX_BYTES:
+                await message.answer(f"Файл больше {PLAN_IMPORT_MAX_BYTES // (1024 * 1024)} МБ, раздели его.")
+                return
+            lines = io.TextIOWrapper(await bot.download(message.document), encoding="utf-8", errors="replace")
+        else:
+            parts = text.split(None, 1)
+            lines = io.StringIO(parts[1] if len(parts) > 1 else "")
+        try:
+            added = await asyncio.to_thread(add_plan_items, parse_plan_lines(lines, today))
+        except sqlite3.Error as e:
+            logging.error("Ошибка импорта плана: %s", e)
+            await message.answer("Импорт не удался, ничего не добавлено. Попробуй ещё раз.")
+            return
+        if not added:
+            await message.answer("Артем, пришли пункты после команды или файлом с подписью /plan_import: "
+                                 "пункт на строку, можно с датой в начале (2025-09-01: тренировка).")
+            return
+        await message.answer(f"Импортировано пунктов плана: {added}.",
+                             reply_markup=get_main_menu(get_daily_score(today)))
+        return
+
+    if user_text.startswith("/export"):
+        # /export [ndjson|csv] — вся история gzip-файлом.
+        args = user_text.split()[1:]
+        fmt = args[0] if args else "ndjson"
+        if fmt not in history.FORMATS:
+            await message.answer(f"Формат: /export [{'|'.join(history.FORMATS)}]")
+            return
+        await message.answer("Собираю выгрузку истории...")
+        path, counts = await asyncio.to_thread(export_history_file, fmt)
+        try:
+            await message.answer_document(
+                FSInputFile(path, filename=f"bvot-history-{datetime.now().strftime('%Y-%m-%d')}.{fmt}.gz"),
+                caption=f"История: {history.format_counts(counts)}")
+        finally:
+            os.remove(path)
+        return
+
+    if user_text.startswith("/import"):
+        # Файл выгрузки с подписью /import; уже существующие строки пропускаются.
+        if not message.document:
+            await message.answer("Пришли файл выгрузки (.ndjson.gz или .csv.gz) с подписью /import.")
+            return
+        fd, path = tempfile.mkstemp(prefix="bvot-import-")
+        os.close(fd)
+        try:
+            await bot.download(message.document, destination=path)
+            counts = await asyncio.to_thread(import_history_file, path)
+        except (ValueError, OSError, sqlite3.Error) as e:
+            logging.error("Ошибка импорта истории: %s", e)
+            await message.answer(f"Импорт прерван: {e}. Уже загруженные пачки сохранены, повторный импорт их пропустит.")
+            return
+        finally:
+            os.remove(path)
+        today = datetime.now().strftime("%Y-%m-%d")
+        await message.answer(f"Импорт завершён. Добавлено: {history.format_counts(counts)}",
+                             reply_markup=get_main_menu(get_daily_score(today)))
+        return
+
+    if user_text.startswith("/chart"):
+        # /chart [7|30|365] — график счёта, по умолчанию за 30 дней.
+        args = user_text.split()[1:]
+        days = int(args[0]) if args and args[0].isdigit() else 30
+        if days not in CHART_RANGES:
+            await message.answer(f"Формат: /chart [{'|'.join(str(period) for period in CHART_RANGES)}]")
+            return
+        await send_chart(message.from_user.id, days)
+        return
+
+    if user_text.startswith("/report"):
+        # /report [week|month] — отчёт по всей истории с разбором ИИ.
+        args = user_text.split()[1:]
+        period_name = args[0] if args else "week"
+        if period_name not in analytics.PERIODS:
+            await message.answer(f"Формат: /report [{'|'.join(analytics.PERIODS)}]")
+            return
+        await send_history_report(period_name)
+        return
+
+    if user_text.startswith("/perf"):
+        summary = metrics.render_summary()
+        await message.answer(summary[:4000])
+        return
+
+    if user_text.startswith("/profile"):
+        # /profile <маршрут> <N | Ns> [cprofile|sample], /profile stop, /profile — статус.
+        args = text.split()[1:]
+        try:
+            if not args:
+                reply = profiling.status()
+            elif args[0] == "stop":
+                # Путь к файлам придёт сообщением из on_finish.
+                profiling.stop()
+                return
+            else:
+                limit = args[1] if len(args) > 1 else "1"
+                count, seconds = (None, float(limit[:-1])) if limit.endswith("s") else (int(limit), None)
+                mode = args[2] if len(args) > 2 else "cprofile"
+                reply = "Профилирование включено: " + profiling.start(
+                    args[0], count=count, seconds=seconds, mode=mode,
+                    out_dir=PROFILE_DIR,
+                    on_finish=lambda text: run_in_background(bot.send_message(CHAT_ID, text)))
+                if mode == "cprofile":
+                    reply += ("\ncProfile снимает весь процесс, пока идёт апдейт маршрута: "
+                              "в отчёт попадут и другие обработчики, выполнявшиеся в это время.")
+        except ValueError as e:
+            reply = f"{e}. Формат: /profile <маршрут> <N | Ns> [cprofile|sample], /profile stop"
+        await message.answer(reply)
+        return
+
     if user_text.startswith("/silly_score"):
         daily_score = get_daily_score(time.strftime("%Y-%m-%d"))
 
@@ -578,15 +1650,27 @@ async def message_handler(message: Message):
     if user_text.startswith("челлендж:"):
         try:
             parts = user_text.replace("челлендж:", "").split("цель:")
-            challenge_name = parts[0].strip()
-            goal = float(parts[1].strip())
+            challenge_name = parts[0].strip().rstrip(",").strip()
+            goal_part, _, action_part = parts[1].partition("действие:")
+            goal = float(goal_part.strip().rstrip(",").strip())
+            # Прогресс считается по действию из каталога: явно указанному или совпадающему с названием.
+            challenge_action = action_part.strip() or (challenge_name if challenge_name in actions else None)
+            if challenge_action and challenge_action not in actions:
+                await message.answer(f"Артем, действия '{challenge_action}' нет в меню. Укажи одно из: "
+                                     f"{', '.join(actions)}.")
+                return
             today = datetime.now().strftime("%Y-%m-%d")
-            save_challenge(challenge_name, today, "2050-01-01", goal, f"Цель - {goal}")
+            save_challenge(challenge_name, today, "2050-01-01", goal, f"Цель - {goal:g}", challenge_action)
             daily_score = get_daily_score(today)
             ai_prompt = f"Артем только что поставил себе новую цель: '{challenge_name}' с целью {goal}. Дай ему мощный мотивирующий толчок, объясни, как дисциплина в этом челлендже поможет ему стать сильнее. Упомяни про дофаминовые зависимости, которые могут мешать и предложи ему написать о них. "
-            ai_response = get_ai_response(ai_prompt)
-            await message.answer(f"Отлично, Артем. Твой челлендж '{challenge_name}' зафиксирован! \n\n{ai_response}",
-                                 reply_markup=get_main_menu(daily_score))
+            ai_response, pending = await get_ai_response_within(
+                "challenge", ai_prompt, render_fallback_response("challenge", daily_score))
+            header = f"Отлично, Артем. Твой челлендж '{challenge_name}' зафиксирован! \n\n"
+            if challenge_action:
+                header += f"Прогресс считается по действию '{challenge_action}': 0 / {goal:g}.\n\n"
+            sent = await message.answer(f"{header}{ai_response}", reply_markup=get_main_menu(daily_score))
+            deliver_late_ai_response(
+                pending, lambda text: sent.edit_text(f"{header}{text}", reply_markup=get_main_menu(daily_score)))
         except Exception as e:
             await message.answer(
                 "Артем, кажется, формат неправильный. Попробуй ещё раз: 'Челлендж: <название>, Цель: <количество>'.")
@@ -596,13 +1680,15 @@ async def message_handler(message: Message):
         try:
             plan_items = [item.strip() for item in user_text.replace("план:", "").split(',')]
             today = datetime.now().strftime("%Y-%m-%d")
-            for item in plan_items:
-                add_plan_item(today, item)
+            add_plan_items((today, item) for item in plan_items if item)
             daily_score = get_daily_score(today)
             ai_prompt = f"Артем, ты только что составил свой план на сегодня. Отправь ему вдохновляющее сообщение о важности следования плану и напомни, что каждый пункт - это шаг к его великой цели."
-            ai_response = get_ai_response(ai_prompt)
-            await message.answer(f"Твой план на сегодня зафиксирован! \n\n{ai_response}",
-                                 reply_markup=get_main_menu(daily_score))
+            ai_response, pending = await get_ai_response_within(
+                "plan", ai_prompt, render_fallback_response("plan", daily_score))
+            header = "Твой план на сегодня зафиксирован! \n\n"
+            sent = await message.answer(f"{header}{ai_response}", reply_markup=get_main_menu(daily_score))
+            deliver_late_ai_response(
+                pending, lambda text: sent.edit_text(f"{header}{text}", reply_markup=get_main_menu(daily_score)))
         except Exception as e:
             await message.answer(
                 "Артем, кажется, формат неправильный. Попробуй ещё раз: 'План: <пункт 1>, <пункт 2>, ...'.")
@@ -610,16 +1696,14 @@ async def message_handler(message: Message):
 
     # Если сообщение не является командой, отправляем его в AI для консультации.
     if "срыв" in user_text or "ломка" in user_text:
-        ai_prompt = f"Артем пишет, что чувствует срыв или ломку. Его сообщение: '{message.text}'. Дай ему максимально конструктивную и жесткую, но поддерживающую консультацию, объясни, как бороться с этим, и напомни о его целях. Не жалей слов, но будь прямолинеен."
-        ai_response = get_ai_response(ai_prompt)
-        await message.answer(ai_response)
+        ai_prompt = f"Артем пишет, что чувствует срыв или ломку. Его сообщение: '{text}'. Дай ему максимально конструктивную и жесткую, но поддерживающую консультацию, объясни, как бороться с этим, и напомни о его целях. Не жалей слов, но будь прямолинеен."
+        await answer_with_memory(message, text, "pmo", ai_prompt, render_fallback_response("pmo"))
         return
 
-    ai_response = get_ai_response(message.text)
-    await message.answer(ai_response)
+    await answer_with_memory(message, text, "chat", text, render_fallback_response("chat"))
 
 
-@dp.callback_query()
+@router.callback_query()
 async def callback_handler(callback: types.CallbackQuery):
     """Обрабатывает все нажатия кнопок."""
     if callback.from_user.id != int(CHAT_ID):
@@ -630,6 +1714,14 @@ async def callback_handler(callback: types.CallbackQuery):
 
         if callback.data == "main_menu":
             daily_score = get_daily_score(date)
+            if callback.message.photo:
+                # Из графика: фото не превратить в текст — график остаётся без кнопок, меню приходит новым сообщением.
+                await callback.message.edit_reply_markup(reply_markup=None)
+                await callback.message.answer(
+                    f"Привет, Артем. Ты на пути к 100 баллам. Сегодня: {daily_score}/100. Выбери действие:",
+                    reply_markup=get_main_menu(daily_score))
+                await callback.answer()
+                return
             await bot.edit_message_text(
                 chat_id=callback.message.chat.id,
                 message_id=callback.message.message_id,
@@ -741,8 +1833,10 @@ async def callback_handler(callback: types.CallbackQuery):
                     reply_markup=get_anti_pmo_menu()
                 )
                 ai_prompt = f"Артем только что совершил срыв PMO. Дай ему конструктивную, жесткую консультацию, объясни, что это не конец, а просто данные для анализа. Расскажи, как правильно использовать это поражение, чтобы стать сильнее."
-                ai_response = get_ai_response(ai_prompt)
-                await bot.send_message(CHAT_ID, ai_response)
+                ai_response, pending = await get_ai_response_within(
+                    "pmo", ai_prompt, render_fallback_response("pmo"))
+                sent = await bot.send_message(CHAT_ID, ai_response)
+                deliver_late_ai_response(pending, lambda text: sent.edit_text(text))
             else:
                 cancel_keyboard = InlineKeyboardMarkup(inline_keyboard=[
                     [InlineKeyboardButton(text="Отменить действие", callback_data=f"undo_{failure}")],
@@ -807,63 +1901,92 @@ async def callback_handler(callback: types.CallbackQuery):
             progress_bar = filled_emoji * filled_blocks + empty_emoji * empty_blocks
 
             ai_prompt = f"Артем, сегодня его прогресс {progress_percent}%. Дай ему мотивирующий комментарий, упомяни о его дофаминовых зависимостях (соцсети, PMO) и о том, как их преодоление приблизит его к цели."
-            ai_response = get_ai_response(ai_prompt)
+            ai_response, pending = await get_ai_response_within(
+                "progress", ai_prompt, render_fallback_response("progress", daily_score))
+            header = (f"**Твой прогресс сегодня:**\n"
+                      f"**{progress_bar}** **{daily_score}** / **100** баллов\n\n")
+            chat_id, message_id = callback.message.chat.id, callback.message.message_id
 
             await bot.edit_message_text(
-                chat_id=callback.message.chat.id,
-                message_id=callback.message.message_id,
-                text=f"**Твой прогресс сегодня:**\n"
-                     f"**{progress_bar}** **{daily_score}** / **100** баллов\n\n"
-                     f"{ai_response}",
+                chat_id=chat_id,
+                message_id=message_id,
+                text=f"{header}{ai_response}",
                 reply_markup=get_main_menu(daily_score),
                 parse_mode="Markdown"
             )
+            deliver_late_ai_response(pending, lambda text: bot.edit_message_text(
+                chat_id=chat_id,
+                message_id=message_id,
+                text=f"{header}{text}",
+                reply_markup=get_main_menu(daily_score),
+                parse_mode="Markdown"
+            ))
             await callback.answer()
 
         elif callback.data == "analyze_day":
             daily_score = get_daily_score(date)
-            daily_actions_log = get_daily_actions(date)
+            action_summary = get_daily_action_summary(date)
 
             # Усиленный AI-анализ.
-            deep_work_points = sum(p for a, p in daily_actions_log if "deep_work" in a.lower() or "кодинг" in a.lower())
-
-            prompt_data = "\n".join([f"- {action[0]}: {action[1]} баллов" for action in daily_actions_log])
-            ai_prompt = f"Мой сегодняшний счет: {daily_score}/100. Список моих действий и баллов:\n{prompt_data}\n\n"
-
-            if deep_work_points < 10:
-                ai_prompt += "Ты заработал мало баллов за Deep Work и кодинг. Твоё тело — машина, но без мозгов она никуда не едет. Сегодня фокус был на рутинах, а не на бизнесе. Завтра — Deep Work. "
-
-            ai_prompt += f"Дай жесткий, но справедливый анализ. Хвали за успехи, но без лишней сентиментальности. Укажи, на что нужно сделать фокус завтра, если он упустил что-то важное. Напомни о '500k'."
-            ai_response = get_ai_response(ai_prompt)
+            tail = ""
+            if get_deep_work_points(action_summary) < 10:
+                tail += "Ты заработал мало баллов за Deep Work и кодинг. Твоё тело — машина, но без мозгов она никуда не едет. Сегодня фокус был на рутинах, а не на бизнесе. Завтра — Deep Work. "
+            tail += "Дай жесткий, но справедливый анализ. Хвали за успехи, но без лишней сентиментальности. Укажи, на что нужно сделать фокус завтра, если он упустил что-то важное. Напомни о '500k'."
+
+            ai_prompt, _ = build_action_log_prompt(
+                "analyze_day",
+                f"Мой сегодняшний счет: {daily_score}/100. Сводка моих действий и баллов:",
+                tail,
+                action_summary
+            )
+            ai_response, pending = await get_ai_response_within(
+                "analyze_day", ai_prompt, render_fallback_response("analyze_day", daily_score, action_summary))
 
-            image_prompt = f"abstract and powerful digital art illustrating a person's journey to becoming a god, with glowing lines of code and determination, ultra high resolution"
-            image_data = get_gemini_image(image_prompt)
+            image_key, photo = await images.get_photo(ANALYZE_DAY_IMAGE_PROMPT, get_gemini_image, IMAGE_VARIANTS)
 
-            if image_data:
-                await bot.send_photo(
+            if photo:
+                sent = await bot.send_photo(
                     CHAT_ID,
-                    photo=BufferedInputFile(image_data, filename="god_mode.png"),
+                    photo=photo,
                     caption=f"**Твой анализ дня:**\n\n{ai_response}",
                     reply_markup=get_main_menu(daily_score),
                     parse_mode="Markdown"
                 )
+                images.remember(image_key, sent)
+                deliver_late_ai_response(pending, lambda text: sent.edit_caption(
+                    caption=f"**Твой анализ дня:**\n\n{text}",
+                    reply_markup=get_main_menu(daily_score),
+                    parse_mode="Markdown"
+                ))
             else:
-                await bot.send_message(
+                sent = await bot.send_message(
                     CHAT_ID,
                     f"**Твой анализ дня:**\n\n{ai_response}",
                     reply_markup=get_main_menu(daily_score),
                     parse_mode="Markdown"
                 )
+                deliver_late_ai_response(pending, lambda text: sent.edit_text(
+                    f"**Твой анализ дня:**\n\n{text}",
+                    reply_markup=get_main_menu(daily_score),
+                    parse_mode="Markdown"
+                ))
             await callback.answer()
 
         elif callback.data == "create_challenge":
-            ai_prompt = f"Артем нажал кнопку 'Создать челлендж'. Дай ему мотивирующее сообщение о постановке целей и попроси написать цель. В конце добавь инструкцию 'Напиши название челленджа и цель в формате: 'Челлендж: <название>, Цель: <количество>'.'"
-            ai_response = get_ai_response(ai_prompt)
+            ai_prompt = f"Артем нажал кнопку 'Создать челлендж'. Дай ему мотивирующее сообщение о постановке целей и попроси написать цель. В конце добавь инструкцию 'Напиши название челленджа и цель в формате: 'Челлендж: <название>, Цель: <количество>, Действие: <действие из меню>'.' и поясни, что прогресс считается по нажатиям этого действия."
+            ai_response, pending = await get_ai_response_within(
+                "create_challenge", ai_prompt, render_fallback_response("create_challenge"))
+            chat_id, message_id = callback.message.chat.id, callback.message.message_id
             await bot.edit_message_text(
-                chat_id=callback.message.chat.id,
-                message_id=callback.message.message_id,
+                chat_id=chat_id,
+                message_id=message_id,
                 text=ai_response,
             )
+            deliver_late_ai_response(pending, lambda text: bot.edit_message_text(
+                chat_id=chat_id,
+                message_id=message_id,
+                text=text,
+            ))
             await callback.answer()
 
         elif callback.data == "show_plan":
@@ -902,12 +2025,19 @@ async def callback_handler(callback: types.CallbackQuery):
 
         elif callback.data == "create_plan":
             ai_prompt = f"Пользователь Артем хочет создать план на день. Спроси его, что он хочет включить в свой план. Мотивируй его на продуктивность. В конце ответа добавь инструкцию 'Напиши свои планы в формате: 'План: <пункт 1>, <пункт 2>, ...''."
-            ai_response = get_ai_response(ai_prompt)
+            ai_response, pending = await get_ai_response_within(
+                "create_plan", ai_prompt, render_fallback_response("create_plan"))
+            chat_id, message_id = callback.message.chat.id, callback.message.message_id
             await bot.edit_message_text(
-                chat_id=callback.message.chat.id,
-                message_id=callback.message.message_id,
+                chat_id=chat_id,
+                message_id=message_id,
                 text=ai_response,
             )
+            deliver_late_ai_response(pending, lambda text: bot.edit_message_text(
+                chat_id=chat_id,
+                message_id=message_id,
+                text=text,
+            ))
             await callback.answer()
 
         elif callback.data == "show_stats":
@@ -925,11 +2055,17 @@ async def callback_handler(callback: types.CallbackQuery):
             )
             await callback.answer()
 
+        elif data[0] == "chart" and data[1].isdigit() and int(data[1]) in CHART_RANGES:
+            # С графика переключаем период в том же сообщении, из меню — присылаем новое.
+            await send_chart(callback.from_user.id, int(data[1]),
+                             edit_message=callback.message if callback.message.photo else None)
+            await callback.answer()
+
         elif callback.data == "noop":
             await callback.answer("Этот пункт плана уже выполнен. Молодцом!")
 
     except Exception as e:
-        logging.error(f"Ошибка в callback: {e}")
+        logging.exception("Ошибка в callback: %s", e)
         daily_score = get_daily_score(date)
         await bot.edit_message_text(
             chat_id=callback.message.chat.id,
@@ -948,108 +2084,413 @@ async def callback_handler(callback: types.CallbackQuery):
 # Этот блок — твои "напоминания" и "автопилот".
 # Здесь бот будет напоминать тебе о целях по расписанию.
 
-async def get_ai_daily_plan(today_date: str) -> str:
+async def get_ai_daily_plan(today_date: str):
     """
     Генерирует персонализированный план на день с помощью AI.
+    Возвращает (текст, pending) — см. get_ai_response_within.
     """
     yesterday = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
-    yesterday_actions = get_daily_actions(yesterday)
-
-    # Готовим данные для AI.
-    actions_summary = ", ".join([f"{a[0]}: {a[1]} баллов" for a in yesterday_actions])
+    yesterday_summary = get_daily_action_summary(yesterday)
     yesterday_score = get_daily_score(yesterday)
 
-    ai_prompt = f"Артем, сегодня {today_date}. Вчера ты набрал {yesterday_score} баллов. Вот список твоих вчерашних действий: {actions_summary}. Твои главные цели: Deep Work, бизнес, кодинг. Составь краткий и жесткий, но мотивирующий план на сегодня. Включи в него конкретные действия, направленные на главные цели (Deep Work, кодинг, бизнес). Начни с 'Твой план на сегодня:' и добавь в конце 'Помни о цели 500k. Ты проиграл лето, не проиграешь год.'."
-    ai_response = get_ai_response(ai_prompt)
-
-    return ai_response
+    # Готовим данные для AI.
+    ai_prompt, _ = build_action_log_prompt(
+        "daily_plan",
+        f"Артем, сегодня {today_date}. Вчера ты набрал {yesterday_score} баллов. Сводка твоих вчерашних действий:",
+        "Твои главные цели: Deep Work, бизнес, кодинг. Составь краткий и жесткий, но мотивирующий план на сегодня. Включи в него конкретные действия, направленные на главные цели (Deep Work, кодинг, бизнес). Начни с 'Твой план на сегодня:' и добавь в конце 'Помни о цели 500k. Ты проиграл лето, не проиграешь год.'.",
+        yesterday_summary
+    )
+    return await get_ai_response_within("daily_plan", ai_prompt, render_fallback_response("daily_plan"))
 
 
+@metrics.timed("bot_job_seconds", job="send_daily_reminder")
 async def send_daily_reminder():
     """Отправляет утреннее напоминание и персонализированный план."""
     today = datetime.now().strftime("%Y-%m-%d")
     daily_score = get_daily_score(today)
 
-    personalized_plan = await get_ai_daily_plan(today)
+    personalized_plan, pending = await get_ai_daily_plan(today)
+    header = (f"**☀️ Начало нового дня, Артем!**\n\n"
+              f"Твой счет на сегодня: {daily_score}/100.\n\n"
+              f"**Твой персонализированный план:**\n\n")
 
-    await bot.send_message(
+    sent = await bot.send_message(
         CHAT_ID,
-        f"**☀️ Начало нового дня, Артем!**\n\n"
-        f"Твой счет на сегодня: {daily_score}/100.\n\n"
-        f"**Твой персонализированный план:**\n\n{personalized_plan}",
+        f"{header}{personalized_plan}",
         reply_markup=get_main_menu(daily_score),
         parse_mode="Markdown"
     )
+    deliver_late_ai_response(pending, lambda text: sent.edit_text(
+        f"{header}{text}",
+        reply_markup=get_main_menu(daily_score),
+        parse_mode="Markdown"
+    ))
     logging.info("Отправлено утреннее напоминание с планом.")
 
 
+def format_challenge(name, description, action, progress, goal) -> str:
+    """Строка напоминания: у челленджа с действием — живой прогресс «X / цель»."""
+    if not action:
+        return f"- {name}\n  {description}"
+    percent = min(100, int(progress / goal * 100)) if goal else 100
+    return f"- {name} — {progress:g} / {goal:g} ({percent}%)\n  действие: {action}"
+
+
+@metrics.timed("bot_job_seconds", job="send_challenges_reminder")
 async def send_challenges_reminder():
     """Отправляет напоминание об активных челленджах."""
     challenges = get_active_challenges()
     if challenges:
-        challenge_list = "\n".join([f"**- {name}**\n_{desc}_" for name, desc in challenges])
+        challenge_list = "\n".join([format_challenge(*challenge) for challenge in challenges])
         daily_score = get_daily_score(time.strftime("%Y-%m-%d"))
+        # Без Markdown: в названиях действий бывают подчёркивания (deep_work),
+        # и незакрытый курсив отклонил бы всё напоминание.
         await bot.send_message(
             CHAT_ID,
-            f"**⚔️ Не забывай о своих челленджах, Артем:**\n\n{challenge_list}",
-            reply_markup=get_main_menu(daily_score),
-            parse_mode="Markdown"
+            f"⚔️ Не забывай о своих челленджах, Артем:\n\n{challenge_list}",
+            reply_markup=get_main_menu(daily_score)
         )
         logging.info("Отправлено напоминание о челленджах.")
 
 
+@metrics.timed("bot_job_seconds", job="send_progress_analysis")
 async def send_progress_analysis():
     """
     Отправляет вечерний анализ прогресса на основе баллов.
     """
     today = datetime.now().strftime("%Y-%m-%d")
     daily_score = get_daily_score(today)
-    daily_actions_log = get_daily_actions(today)
-
-    deep_work_points = sum(p for a, p in daily_actions_log if "deep_work" in a.lower() or "кодинг" in a.lower())
-
-    prompt_data = "\n".join([f"- {action[0]}: {action[1]} баллов" for action in daily_actions_log])
-    ai_prompt = f"Проанализируй день Артема. Его счет сегодня: {daily_score}/100. Список действий:\n{prompt_data}\n\n"
-
-    if deep_work_points < 10:
-        ai_prompt += "Ты заработал мало баллов за Deep Work и кодинг. Твоё тело — машина, но без мозгов она никуда не едет. Сегодня фокус был на рутинах, а не на бизнесе. Завтра — Deep Work. "
-
-    ai_prompt += f"Дай жесткий, но справедливый анализ. Хвали за успехи, но без лишней сентиментальности. Укажи, на что нужно сделать фокус завтра, если он упустил что-то важное. Напомни о '500k'."
-    ai_response = get_ai_response(ai_prompt)
+    action_summary = get_daily_action_summary(today)
+
+    tail = ""
+    if get_deep_work_points(action_summary) < 10:
+        tail += "Ты заработал мало баллов за Deep Work и кодинг. Твоё тело — машина, но без мозгов она никуда не едет. Сегодня фокус был на рутинах, а не на бизнесе. Завтра — Deep Work. "
+    tail += "Дай жесткий, но справедливый анализ. Хвали за успехи, но без лишней сентиментальности. Укажи, на что нужно сделать фокус завтра, если он упустил что-то важное. Напомни о '500k'."
+
+    ai_prompt, _ = build_action_log_prompt(
+        "evening_analysis",
+        f"Проанализируй день Артема. Его счет сегодня: {daily_score}/100. Сводка действий:",
+        tail,
+        action_summary
+    )
+    ai_response, pending = await get_ai_response_within(
+        "evening_analysis", ai_prompt, render_fallback_response("evening_analysis", daily_score, action_summary))
 
-    await bot.send_message(
+    sent = await bot.send_message(
         CHAT_ID,
         f"**🌙 Анализ дня, Артем:**\n\n{ai_response}",
         reply_markup=get_main_menu(daily_score),
         parse_mode="Markdown"
     )
+    deliver_late_ai_response(pending, lambda text: sent.edit_text(
+        f"**🌙 Анализ дня, Артем:**\n\n{text}",
+        reply_markup=get_main_menu(daily_score),
+        parse_mode="Markdown"
+    ))
     logging.info("Отправлен вечерний анализ прогресса.")
 
 
+@metrics.timed("bot_job_seconds", job="history_report")
+async def send_history_report(period_name: str = "week"):
+    """
+    Отправляет недельный или месячный отчёт: сводку аналитики по всей истории
+    и разбор ИИ, которому уходит эта сводка, а не сырые строки журнала.
+    """
+    report = await asyncio.to_thread(get_history_report, analytics.PERIODS[period_name])
+    summary = analytics.format_report(report)
+    period_text = "неделю" if period_name == "week" else "месяц"
+    ai_prompt = (f"Вот сводка Артема за {period_text} на фоне всей его истории:\n{summary}\n\n"
+                 "Разбери тренды: что растёт, что проседает, в какие дни недели он слабее и какие срывы тянут "
+                 "друг друга. Дай три конкретных шага на следующий период. Жёстко, но справедливо. Напомни о '500k'.")
+    ai_response, pending = await get_ai_response_within("report", ai_prompt, render_fallback_response("report", report=report))
+
+    # Без Markdown: в названиях действий бывают подчёркивания (deep_work).
+    header = f"📊 Отчёт за {period_text}, Артем:\n\n{summary}\n\n"
+    sent = await bot.send_message(CHAT_ID, f"{header}{ai_response}"[:4000])
+    deliver_late_ai_response(pending, lambda text: sent.edit_text(f"{header}{text}"[:4000]))
+    logging.info("Отправлен отчёт за %s.", period_text)
+
+
+def _is_month_end() -> bool:
+    return (datetime.now() + timedelta(days=1)).day == 1
+
+
+@metrics.timed("bot_job_seconds", job="retention")
+async def run_retention():
+    """Ночная задача: архивирует старый журнал действий, не блокируя цикл событий."""
+    try:
+        await asyncio.to_thread(compact_actions_log, RETENTION_DAYS)
+    except sqlite3.Error as e:
+        logging.error("Ошибка архивации журнала: %s", e)
+
+
+# Поток планировщика и сигнал его остановки.
+_scheduler_stop = threading.Event()
+_scheduler_thread = None
+_metrics_runner = None
+
+# Аренда лидера планировщика: планировщик тикает в каждом процессе,
+# но задачи запускает только держатель аренды.
+SCHEDULER_LEASE = "scheduler"
+_lease_holder = workers.holder_id()
+_is_leader = False
+# Задачи, которые этот процесс пропустил как не лидер: имя -> (make_coro, день, когда пропущена).
+_missed_jobs = {}
+
+
+def hold_scheduler_lease() -> bool:
+    """Берёт или продлевает аренду лидера. Ошибка базы — значит, не лидер."""
+    global _is_leader
+    conn = connect_db()
+    try:
+        leader = workers.acquire_lease(conn, SCHEDULER_LEASE, _lease_holder, LEADER_LEASE_TTL)
+    except sqlite3.Error as e:
+        logging.error("Ошибка продления аренды лидера: %s", e)
+        leader = False
+    finally:
+        conn.close()
+    if leader != _is_leader:
+        logging.info("Процесс %s %s лидером планировщика.", _lease_holder, "стал" if leader else "перестал быть")
+        _is_leader = leader
+    return leader
+
+
+def release_scheduler_lease():
+    """Отпускает аренду при остановке, чтобы другой процесс стал лидером сразу."""
+    global _is_leader
+    if not _is_leader:
+        return
+    conn = connect_db()
+    try:
+        workers.release_lease(conn, SCHEDULER_LEASE, _lease_holder)
+    except sqlite3.Error as e:
+        logging.error("Ошибка освобождения аренды лидера: %s", e)
+    finally:
+        conn.close()
+    _is_leader = False
+
+
+def leader_job(name: str, make_coro, condition=None):
+    """
+    Задача планировщика, которая запускается только у лидера. Аренда продлевается
+    прямо перед запуском: процесс, который проспал истечение аренды, задачу не запустит.
+    Пропущенную задачу процесс запоминает и догоняет, если сам станет лидером (см. catch_up_jobs).
+    """
+    def job():
+        if condition is not None and not condition():
+            return None
+        slot = datetime.now().strftime("%Y-%m-%d")
+        if not hold_scheduler_lease():
+            logging.debug("Задача %s пропущена: процесс не лидер.", name)
+            _missed_jobs[name] = (make_coro, slot, time.monotonic())
+            return None
+        return asyncio.create_task(run_leader_job(name, make_coro, slot))
+    return job
+
+
+def _job_done(name: str, slot: str, mark: bool = False) -> bool:
+    """Проверяет (или ставит) отметку о выполнении задачи за день."""
+    conn = connect_db()
+    try:
+        if mark:
+            workers.mark_job_done(conn, name, slot)
+            return True
+        return workers.job_done(conn, name, slot)
+    finally:
+        conn.close()
+
+
+async def run_leader_job(name: str, make_coro, slot: str):
+    """Выполняет задачу лидера и отмечает её выполненной за день slot."""
+    await make_coro()
+    try:
+        await asyncio.to_thread(_job_done, name, slot, True)
+    except sqlite3.Error as e:
+        logging.error("Не удалось отметить задачу %s выполненной: %s", name, e)
+
+
+def catch_up_jobs():
+    """
+    У нового лидера: запускает задачи, которые процесс пропустил, пока лидером был другой,
+    если тот их так и не выполнил и окно LEADER_JOB_CATCH_UP ещё не прошло.
+    """
+    for name, (make_coro, slot, missed_at) in list(_missed_jobs.items()):
+        if time.monotonic() - missed_at > LEADER_JOB_CATCH_UP:
+            del _missed_jobs[name]
+            continue
+        try:
+            done = _job_done(name, slot)
+        except sqlite3.Error as e:
+            logging.error("Ошибка проверки задачи %s: %s", name, e)
+            continue
+        del _missed_jobs[name]
+        if not done:
+            logging.warning("Задача %s за %s не выполнена прежним лидером, запускаем.", name, slot)
+            asyncio.create_task(run_leader_job(name, make_coro, slot))
+
+
 async def scheduler_loop():
-    """Запускает цикл планировщика задач."""
-    while True:
+    """Запускает цикл планировщика задач до сигнала остановки, продлевая аренду лидера."""
+    renewed = 0.0
+    while not _scheduler_stop.is_set():
+        if time.monotonic() - renewed >= LEADER_LEASE_RENEW:
+            if hold_scheduler_lease() and _missed_jobs:
+                catch_up_jobs()
+            renewed = time.monotonic()
         schedule.run_pending()
         await asyncio.sleep(1)
 
+    # Даём уже начатым рассылкам закончиться.
+    pending = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    if pending:
+        await asyncio.wait(pending, timeout=SHUTDOWN_DRAIN_TIMEOUT)
+
+
+def start_scheduler():
+    """Планирует ежедневные задачи и запускает поток планировщика."""
+    global _scheduler_thread
+    schedule.clear()
+    schedule.every().day.at("09:00").do(leader_job("daily_reminder", send_daily_reminder))
+    schedule.every().day.at("12:00").do(leader_job("challenges_reminder", send_challenges_reminder))
+    schedule.every().day.at("21:00").do(leader_job("progress_analysis", send_progress_analysis))
+    schedule.every().sunday.at("20:00").do(leader_job("report_week", lambda: send_history_report("week")))
+    schedule.every().day.at("20:05").do(
+        leader_job("report_month", lambda: send_history_report("month"), condition=_is_month_end))
+    if RETENTION_DAYS:
+        schedule.every().day.at("03:30").do(leader_job("retention", run_retention))
+
+    _scheduler_stop.clear()
+    _scheduler_thread = threading.Thread(target=lambda: asyncio.run(scheduler_loop()), name="scheduler")
+    _scheduler_thread.start()
+
+
+def stop_scheduler():
+    """Останавливает поток планировщика (блокирующе), дав начатым задачам завершиться."""
+    global _scheduler_thread
+    if _scheduler_thread is None:
+        return
+    _scheduler_stop.set()
+    _scheduler_thread.join()
+    _scheduler_thread = None
 
-async def main():
-    """Главная функция для запуска бота."""
-    # Планируем ежедневные задачи
-    schedule.every().day.at("09:00").do(lambda: asyncio.create_task(send_daily_reminder()))
-    schedule.every().day.at("12:00").do(lambda: asyncio.create_task(send_challenges_reminder()))
-    schedule.every().day.at("21:00").do(lambda: asyncio.create_task(send_progress_analysis()))
 
-    scheduler_thread = threading.Thread(target=lambda: asyncio.run(scheduler_loop()))
-    scheduler_thread.start()
+async def on_startup():
+    """Хук запуска: база, планировщик и эндпоинт метрик."""
+    global _metrics_runner
+    init_db()
+    start_scheduler()
+
+    if METRICS_PORT:
+        _metrics_runner = await metrics.start_http_server(METRICS_HOST, METRICS_PORT)
+        logging.info("Метрики доступны на http://%s:%s/metrics", METRICS_HOST, METRICS_PORT)
+
+    # Пул иллюстраций к анализу дня: догенерирует только то, чего нет в дисковом кэше.
+    # Кэш общий для всех воркеров, поэтому заполняет его только лидер.
+    if IMAGE_VARIANTS > 1 and await asyncio.to_thread(hold_scheduler_lease):
+        run_in_background(images.fill(ANALYZE_DAY_IMAGE_PROMPT, get_gemini_image, IMAGE_VARIANTS))
 
     logging.info("Бот запущен. Ожидание сообщений...")
+
+
+async def on_shutdown():
+    """
+    Хук остановки: дожидается обработчиков и фоновых задач в полёте,
+    сбрасывает кэши и гасит планировщик и метрики.
+    """
+    global _metrics_runner
+    if profiling.is_active():
+        await profiling.stop()
+
+    loop = asyncio.get_running_loop()
+    pending = {task for task in _in_flight_handlers | _background_tasks
+               if task.get_loop() is loop and task is not asyncio.current_task()}
+    if pending:
+        logging.info("Остановка: ждём %d задач в полёте...", len(pending))
+        _, still_running = await asyncio.wait(pending, timeout=SHUTDOWN_DRAIN_TIMEOUT)
+        if still_running:
+            logging.warning("Остановка: %d задач не успели завершиться.", len(still_running))
+
+    try:
+        await asyncio.wait_for(flush_conversation_memory(), timeout=SHUTDOWN_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logging.warning("Остановка: память разговора сброшена не полностью.")
+
+    await asyncio.to_thread(stop_scheduler)
+    await asyncio.to_thread(release_scheduler_lease)
+    await asyncio.to_thread(images.shutdown)
+
+    if _metrics_runner is not None:
+        await _metrics_runner.cleanup()
+        _metrics_runner = None
+    logging.info("Бот остановлен.")
+
+
+async def main():
+    """Главная функция для запуска бота."""
+    bot, dp = create_app()
     await dp.start_polling(bot)
 
 
+async def run_worker(index: int, updates):
+    """
+    Воркер режима нескольких процессов: берёт апдейты из своей очереди
+    (их раздаёт родитель, см. workers.py) и обрабатывает их, как polling, — задачей на апдейт.
+    Эндпоинт метрик у воркера свой: METRICS_PORT + 1 + index.
+    """
+    global METRICS_PORT
+    bot, dp = create_app()
+    if METRICS_PORT:
+        METRICS_PORT += 1 + index
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    async def feed(update):
+        try:
+            await dp.feed_update(bot, update)
+        except Exception:
+            logging.exception("Ошибка обработки апдейта %s", update.update_id)
+
+    await dp.emit_startup(bot=bot, dispatcher=dp)
+    try:
+        while not stop.is_set():
+            raw = await asyncio.to_thread(workers.next_update, updates)
+            if raw is workers.STOP:
+                break
+            if raw is not None:
+                run_in_background(feed(types.Update.model_validate_json(raw, context={"bot": bot})))
+    finally:
+        await dp.emit_shutdown(bot=bot, dispatcher=dp)
+        await bot.session.close()
+
+
+def worker_process(index: int, updates):
+    """Точка входа процесса-воркера (запускается через multiprocessing spawn)."""
+    configure_logging()
+    asyncio.run(run_worker(index, updates))
+
+
+def run_workers(count: int):
+    """Режим нескольких процессов: родитель получает апдейты и раздаёт их count воркерам по user_id."""
+    load_config()
+    workers.run_supervisor(count, make_bot, worker_process, allowed_updates=router.resolve_used_update_types())
+
+
 if __name__ == "__main__":
+    import argparse
+
+    configure_logging()
+    parser = argparse.ArgumentParser(description="Запуск бота.")
+    parser.add_argument("--workers", type=int, default=int(getenv("BOT_WORKERS", 1)),
+                        help="число процессов-воркеров (по умолчанию BOT_WORKERS или 1 — один процесс)")
+    args = parser.parse_args()
     try:
-        asyncio.run(main())
+        if args.workers > 1:
+            run_workers(args.workers)
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
         logging.info("Бот остановлен вручную.")
 
@@ -0,0 +1,197 @@
+# --- МЕТРИКИ БОТА ---
+
+# Лёгкие гистограммы и счётчики в памяти процесса.
+# Запись метрики — это bisect по корзинам и пара инкрементов под замком,
+# единицы микросекунд, поэтому метрики можно держать включёнными всегда.
+# Отдаются в формате Prometheus (render_prometheus) на локальном /metrics
+# и кратким текстом для админской команды /perf (render_summary).
+
+import asyncio
+import bisect
+import functools
+import threading
+import time
+
+# Верхние границы корзин гистограмм, в секундах.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+# Слушатели наблюдений (например, трассировка профилировщика).
+# Пока список пуст, observe не тратит на них ничего.
+_listeners = []
+_help = {
+    "bot_handler_seconds": "Длительность обработки апдейта по маршруту.",
+    "bot_external_seconds": "Длительность вызова внешнего сервиса.",
+    "bot_external_errors_total": "Ошибки вызовов внешних сервисов.",
+    "bot_ai_tokens_total": "Токены OpenRouter по видам.",
+    "bot_ai_deadline_total": "Ответы ИИ: уложились в бюджет или заменены шаблоном.",
+    "bot_db_query_seconds": "Длительность функций базы данных.",
+    "bot_job_seconds": "Длительность задач планировщика.",
+    "bot_cache_requests_total": "Обращения к кэшам: попадания и промахи.",
+    "bot_log_dropped_total": "Записи лога, отброшенные из-за переполненной очереди.",
+    "bot_image_seconds": "Длительность перекодирования картинок.",
+    "bot_image_bytes_total": "Байты картинок: от генератора и после перекодирования.",
+}
+
+
+def _key(name: str, labels: dict):
+    return name, tuple(sorted(labels.items()))
+
+
+def observe(name: str, value: float, **labels):
+    """Добавляет наблюдение (в секундах) в гистограмму."""
+    index = bisect.bisect_left(DEFAULT_BUCKETS, value)
+    key = _key(name, labels)
+    with _lock:
+        series = _histograms.get(key)
+        if series is None:
+            series = _histograms[key] = [[0] * (len(DEFAULT_BUCKETS) + 1), 0.0, 0]
+        series[0][index] += 1
+        series[1] += value
+        series[2] += 1
+    for listener in _listeners:
+        listener(name, value, labels)
+
+
+def add_listener(listener):
+    """Подписывает listener(name, value, labels) на все наблюдения гистограмм."""
+    _listeners.append(listener)
+
+
+def remove_listener(listener):
+    """Отписывает слушателя наблюдений."""
+    if listener in _listeners:
+        _listeners.remove(listener)
+
+
+def inc(name: str, value: float = 1, **labels):
+    """Увеличивает счётчик."""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def timed(name: str, **labels):
+    """
+    Декоратор: пишет длительность вызова в гистограмму name.
+    Без меток добавляет метку function=<имя функции>. Работает и с корутинами.
+    """
+    def decorator(func):
+        series_labels = labels or {"function": func.__name__}
+
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    observe(name, time.perf_counter() - started, **series_labels)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                observe(name, time.perf_counter() - started, **series_labels)
+        return wrapper
+
+    return decorator
+
+
+def _snapshot():
+    with _lock:
+        histograms = {key: (list(s[0]), s[1], s[2]) for key, s in _histograms.items()}
+        counters = dict(_counters)
+    return histograms, counters
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (f'{k}="' + str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+               for k, v in pairs)
+    return "{" + ",".join(escaped) + "}"
+
+
+def render_prometheus() -> str:
+    """Отдаёт все метрики в текстовом формате Prometheus."""
+    histograms, counters = _snapshot()
+    lines = []
+    described = set()
+
+    def header(name, kind):
+        if name not in described:
+            described.add(name)
+            lines.append(f"# HELP {name} {_help.get(name, name)}")
+            lines.append(f"# TYPE {name} {kind}")
+
+    for (name, labels), (buckets, total, count) in sorted(histograms.items()):
+        header(name, "histogram")
+        cumulative = 0
+        for bound, bucket_count in zip(DEFAULT_BUCKETS, buckets):
+            cumulative += bucket_count
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+        lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {count}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+        lines.append(f"{name}_count{_format_labels(labels)} {count}")
+
+    for (name, labels), value in sorted(counters.items()):
+        header(name, "counter")
+        lines.append(f"{name}{_format_labels(labels)} {value}")
+
+    return "\n".join(lines) + "\n"
+
+
+def _quantile(buckets, count, q):
+    """Оценка квантиля по корзинам: верхняя граница корзины, где он лежит."""
+    if not count:
+        return 0.0
+    target = q * count
+    cumulative = 0
+    for bound, bucket_count in zip(DEFAULT_BUCKETS, buckets):
+        cumulative += bucket_count
+        if cumulative >= target:
+            return bound
+    return float("inf")
+
+
+def render_summary(limit: int = 40) -> str:
+    """Краткая сводка для /perf: самые частые серии с p50/p95/p99 и счётчики."""
+    histograms, counters = _snapshot()
+    if not histograms and not counters:
+        return "Метрик пока нет."
+
+    lines = []
+    for (name, labels), (buckets, total, count) in sorted(
+            histograms.items(), key=lambda item: -item[1][2])[:limit]:
+        label_text = ",".join(str(v) for _, v in labels)
+        lines.append(f"{name.replace('bot_', '').replace('_seconds', '')}[{label_text}] "
+                     f"n={count} avg={total / count * 1000:.1f}мс "
+                     f"p50≤{_quantile(buckets, count, 0.5) * 1000:g} "
+                     f"p95≤{_quantile(buckets, count, 0.95) * 1000:g} "
+                     f"p99≤{_quantile(buckets, count, 0.99) * 1000:g}мс")
+    for (name, labels), value in sorted(counters.items()):
+        label_text = ",".join(str(v) for _, v in labels)
+        lines.append(f"{name.replace('bot_', '')}[{label_text}] = {value:g}")
+    return "\n".join(lines)
+
+
+async def start_http_server(host: str, port: int):
+    """Поднимает локальный HTTP-сервер с /metrics. Возвращает runner для остановки."""
+    from aiohttp import web
+
+    async def handle_metrics(request):
+        return web.Response(text=render_prometheus(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
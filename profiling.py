@@ -0,0 +1,246 @@
+# --- ПРОФИЛИРОВАНИЕ ПО ЗАПРОСУ ---
+
+# Админ включает профилирование следующих N апдейтов или временного окна
+# для выбранного маршрута (например, analyze_day или add_*), не перезапуская бота.
+# В режиме "cprofile" пишется cProfile (.prof и текстовый отчёт), в обоих режимах —
+# стеки сэмплера в свёрнутом формате (stacks.collapsed, подходит для flamegraph.pl
+# и speedscope) и трассы: каждое профилированное обновление со всеми его
+# запросами к БД и внешними вызовами (traces.jsonl).
+#
+# cProfile включается в потоке цикла событий, поэтому, пока идёт профилируемый
+# апдейт, в .prof попадает всё, что этот цикл выполняет: обработчики других
+# апдейтов, фоновые задачи, планировщик. Это профиль процесса за окно
+# обработки, а не одного обработчика; вклад самого маршрута видно в трассах
+# и в стеках под его функциями.
+#
+# Трассы собираются из наблюдений metrics: пока сессия активна, profiling
+# подписан на metrics.observe и привязывает наблюдения к текущему апдейту
+# через contextvars (они доезжают и в asyncio.to_thread).
+
+import asyncio
+import contextvars
+import cProfile
+import fnmatch
+import io
+import json
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+import metrics
+
+# Шаг сэмплера стеков, в секундах.
+SAMPLE_INTERVAL = 0.005
+# Максимальная длина окна профилирования.
+MAX_WINDOW_SECONDS = 3600
+MODES = ("cprofile", "sample")
+
+_current_trace = contextvars.ContextVar("profiling_trace", default=None)
+_session = None
+# Задачи записи файлов завершённых сессий (держим ссылки, пока они идут).
+_writing = set()
+
+
+class ProfileSession:
+    """Одна сессия профилирования: фильтр маршрута, лимит и собранные данные."""
+
+    def __init__(self, route: str, count, seconds, mode: str, out_dir: str, on_finish):
+        self.route = route
+        self.remaining = count
+        self.deadline = time.monotonic() + seconds if seconds else None
+        self.mode = mode
+        self.out_dir = out_dir
+        self.on_finish = on_finish
+        self.in_flight = 0
+        self.profiled = 0
+        self.profiler = cProfile.Profile() if mode == "cprofile" else None
+        self.stacks = Counter()
+        self.traces = []
+        self._stop_sampler = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, name="profiling-sampler", daemon=True)
+        self._sampler.start()
+
+    def describe(self) -> str:
+        limit = f"{self.remaining} апдейтов" if self.remaining is not None else \
+            f"ещё {max(0, int(self.deadline - time.monotonic()))} с"
+        return f"маршрут '{self.route}', режим {self.mode}, осталось: {limit}, снято: {self.profiled}"
+
+    def expired(self) -> bool:
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            return True
+        return self.remaining is not None and self.remaining <= 0
+
+    def _sample(self):
+        """Снимает стеки всех потоков, пока идёт хотя бы один профилируемый апдейт."""
+        own_id = threading.get_ident()
+        while not self._stop_sampler.wait(SAMPLE_INTERVAL):
+            if not self.in_flight:
+                continue
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def write(self) -> str:
+        """Останавливает сбор и пишет все файлы сессии. Возвращает каталог."""
+        self._stop_sampler.set()
+        self._sampler.join()
+        route_slug = "".join(ch if ch.isalnum() else "_" for ch in self.route) or "any"
+        directory = os.path.join(self.out_dir, f"{datetime.now().strftime('%Y%m%d-%H%M%S')}_{route_slug}")
+        os.makedirs(directory, exist_ok=True)
+
+        if self.profiler is not None:
+            self.profiler.dump_stats(os.path.join(directory, "profile.prof"))
+            report = io.StringIO()
+            pstats.Stats(self.profiler, stream=report).sort_stats("cumulative").print_stats(60)
+            with open(os.path.join(directory, "profile.txt"), "w", encoding="utf-8") as f:
+                f.write(report.getvalue())
+
+        with open(os.path.join(directory, "stacks.collapsed"), "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+        with open(os.path.join(directory, "traces.jsonl"), "w", encoding="utf-8") as f:
+            for trace in self.traces:
+                f.write(json.dumps(trace, ensure_ascii=False) + "\n")
+
+        return directory
+
+
+def _record_span(name: str, value: float, labels: dict):
+    """Слушатель metrics: добавляет наблюдение в трассу текущего апдейта."""
+    trace = _current_trace.get()
+    if trace is None or name == "bot_handler_seconds" or "_started" not in trace:
+        return
+    end = time.perf_counter() - trace["_started"]
+    trace["spans"].append({
+        "metric": name,
+        **labels,
+        "start_ms": round((end - value) * 1000, 3),
+        "duration_ms": round(value * 1000, 3),
+    })
+
+
+def start(route: str, count=None, seconds=None, mode: str = "cprofile", out_dir: str = "profiles",
+          on_finish=None) -> str:
+    """
+    Включает профилирование маршрута на count апдейтов или seconds секунд.
+    on_finish(text) вызывается, когда файлы записаны.
+    """
+    global _session
+    if _session is not None:
+        raise ValueError(f"Профилирование уже идёт: {_session.describe()}")
+    if mode not in MODES:
+        raise ValueError(f"Неизвестный режим '{mode}', доступны: {', '.join(MODES)}")
+    if not count and not seconds:
+        raise ValueError("Укажи число апдейтов или окно в секундах")
+    if seconds and seconds > MAX_WINDOW_SECONDS:
+        raise ValueError(f"Окно не больше {MAX_WINDOW_SECONDS} с")
+
+    _session = ProfileSession(route, count, seconds, mode, out_dir, on_finish)
+    metrics.add_listener(_record_span)
+    if seconds:
+        # Окно должно закрыться, даже если нужных апдейтов больше не придёт.
+        asyncio.get_running_loop().call_later(seconds, check_deadline)
+    logging.info("Профилирование включено: %s", _session.describe())
+    return _session.describe()
+
+
+def stop() -> asyncio.Task:
+    """Досрочно завершает сессию. Возвращает задачу записи файлов; её результат — каталог."""
+    if _session is None:
+        raise ValueError("Профилирование не запущено")
+    return _finish()
+
+
+def status() -> str:
+    """Состояние текущей сессии."""
+    return _session.describe() if _session is not None else "Профилирование не запущено."
+
+
+def is_active() -> bool:
+    """Идёт ли сейчас сессия профилирования."""
+    return _session is not None
+
+
+def check_deadline():
+    """Завершает сессию, если окно истекло, а профилируемых апдейтов в полёте нет."""
+    if _session is not None and _session.expired() and not _session.in_flight:
+        _finish()
+
+
+def wants(route: str) -> bool:
+    """Решает, профилировать ли апдейт этого маршрута, и резервирует для него место."""
+    session = _session
+    if session is None:
+        return False
+    check_deadline()
+    if _session is None or _session.expired():
+        return False
+    if route != session.route and session.route != "*" and not fnmatch.fnmatchcase(route, session.route):
+        return False
+    if session.remaining is not None:
+        session.remaining -= 1
+    return True
+
+
+async def run_profiled(awaitable, update_id: int, route: str):
+    """
+    Выполняет обработку апдейта под профилировщиком и собирает его трассу.
+    В режиме cprofile профилируется весь цикл событий, пока апдейт в полёте,
+    включая чужие корутины, которые успели выполниться в это время.
+    """
+    session = _session
+    trace = {"update_id": update_id, "route": route, "at": datetime.now().isoformat(timespec="milliseconds"),
+             "spans": [], "_started": time.perf_counter()}
+    token = _current_trace.set(trace)
+    session.in_flight += 1
+    if session.profiler is not None and session.in_flight == 1:
+        session.profiler.enable()
+    try:
+        return await awaitable
+    finally:
+        session.in_flight -= 1
+        if session.profiler is not None and session.in_flight == 0:
+            session.profiler.disable()
+        _current_trace.reset(token)
+        trace["duration_ms"] = round((time.perf_counter() - trace.pop("_started")) * 1000, 3)
+        session.traces.append(trace)
+        session.profiled += 1
+        if session is _session:
+            check_deadline()
+
+
+def _finish() -> asyncio.Task:
+    """Закрывает сессию сразу, а файлы пишет в потоке: dump_stats и отчёт pstats не должны стоять в цикле."""
+    global _session
+    session, _session = _session, None
+    metrics.remove_listener(_record_span)
+    if session.profiler is not None:
+        # Выключаем в потоке цикла: из другого потока cProfile не выключить.
+        session.profiler.disable()
+    task = asyncio.ensure_future(_write(session))
+    _writing.add(task)
+    task.add_done_callback(_writing.discard)
+    return task
+
+
+async def _write(session: ProfileSession) -> str:
+    directory = await asyncio.to_thread(session.write)
+    logging.info("Профилирование завершено (%d апдейтов). Файлы: %s", session.profiled, directory)
+    text = f"Профилирование завершено ({session.profiled} апдейтов). Файлы: {directory}"
+    if session.on_finish:
+        session.on_finish(text)
+    return directory
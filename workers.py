@@ -0,0 +1,180 @@
+# --- НЕСКОЛЬКО ПРОЦЕССОВ И АРЕНДА ЛИДЕРА ---
+
+# Режим `python main.py --workers N` (или BOT_WORKERS=N): родительский процесс
+# только забирает апдейты из Telegram (long polling — у бота может быть лишь
+# один получатель getUpdates) и раскладывает их по очередям N процессов-воркеров
+# по user_id. Все апдейты одного пользователя попадают в один воркер, поэтому
+# его кэши (память разговора, графики) остаются согласованными, а порядок
+# апдейтов пользователя сохраняется. Упавший воркер перезапускается с новой
+# очередью: процесс, убитый посреди get(), оставляет замок старой очереди
+# занятым навсегда, поэтому апдейты, которые он не успел забрать, теряются.
+#
+# Рассылки по расписанию должен делать ровно один процесс. Для этого в SQLite
+# лежит аренда (таблица leases): держатель продлевает её каждые несколько
+# секунд, а задачу планировщика запускает только тот, кто только что успешно
+# продлил аренду. Если лидер умер, аренда истекает через LEADER_LEASE_TTL секунд
+# и её забирает другой процесс — в том числе вторая копия бота, запущенная
+# без --workers. При мягкой остановке аренда отпускается сразу.
+#
+# Лидер может умереть уже после времени задачи, пока аренда ещё действует:
+# остальные процессы в этот момент задачу пропустили, потому что не были лидерами.
+# Поэтому выполненная задача отмечается в таблице job_runs (задача, день),
+# а процесс, ставший лидером, запускает пропущенные задачи без такой отметки.
+# Если лидер умер посреди задачи, она выполнится ещё раз — лучше дважды, чем никогда.
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import socket
+import time
+
+# Таймаут long polling родителя и пауза после ошибки getUpdates, в секундах.
+POLL_TIMEOUT = 30
+POLL_RETRY_DELAY = 5
+# Через сколько секунд перезапускать упавший воркер и как долго ждать воркеры при остановке.
+RESPAWN_DELAY = 1
+STOP_TIMEOUT = 60
+
+# Сигнал воркеру «очередь закрыта, пора останавливаться».
+STOP = object()
+
+
+def holder_id() -> str:
+    """Имя держателя аренды: хост и pid процесса."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def acquire_lease(conn, name: str, holder: str, ttl: float) -> bool:
+    """
+    Берёт или продлевает аренду name одним атомарным UPSERT:
+    получится, если аренда свободна, истекла или уже наша.
+    """
+    now = time.time()
+    c = conn.execute(
+        "INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?) "
+        "ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at "
+        "WHERE leases.holder = excluded.holder OR leases.expires_at < ?",
+        (name, holder, now + ttl, now))
+    conn.commit()
+    return c.rowcount > 0
+
+
+def release_lease(conn, name: str, holder: str):
+    """Отпускает аренду, если она наша, чтобы другой процесс забрал её без ожидания TTL."""
+    conn.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (name, holder))
+    conn.commit()
+
+
+def mark_job_done(conn, job: str, slot: str):
+    """Отмечает, что задача job за слот slot (день) выполнена."""
+    conn.execute("INSERT OR REPLACE INTO job_runs (job, slot, finished_at) VALUES (?, ?, ?)",
+                 (job, slot, time.time()))
+    conn.commit()
+
+
+def job_done(conn, job: str, slot: str) -> bool:
+    """Выполнена ли задача job за слот slot каким-либо процессом."""
+    return conn.execute("SELECT 1 FROM job_runs WHERE job = ? AND slot = ?", (job, slot)).fetchone() is not None
+
+
+def partition(update, count: int) -> int:
+    """Номер воркера для апдейта: по user_id, иначе по чату, иначе по update_id."""
+    try:
+        event = update.event
+    except Exception:
+        event = None
+    user = getattr(event, "from_user", None)
+    chat = getattr(event, "chat", None)
+    key = user.id if user else chat.id if chat else update.update_id
+    return key % count
+
+
+def next_update(updates, timeout: float = 1.0):
+    """
+    В воркере: следующий апдейт из очереди (JSON-строка), STOP при закрытии очереди
+    или смерти родителя, None, если за timeout ничего не пришло.
+    """
+    try:
+        item = updates.get(timeout=timeout)
+    except queue.Empty:
+        parent = multiprocessing.parent_process()
+        return STOP if parent is not None and not parent.is_alive() else None
+    return STOP if item is None else item
+
+
+def run_supervisor(count: int, make_bot, target, allowed_updates=None):
+    """
+    Родительский процесс: запускает count воркеров target(index, очередь)
+    и раздаёт им апдейты до SIGINT/SIGTERM, затем дожидается их мягкой остановки.
+    target должен быть функцией модуля верхнего уровня (процессы стартуют через spawn).
+    """
+    context = multiprocessing.get_context("spawn")
+    queues = [context.Queue() for _ in range(count)]
+    processes = [None] * count
+
+    def start(index):
+        if processes[index] is not None:
+            queues[index] = context.Queue()
+        process = context.Process(target=target, args=(index, queues[index]), name=f"worker-{index}")
+        process.start()
+        processes[index] = process
+        logging.info("Воркер %d запущен (pid %s).", index, process.pid)
+
+    for index in range(count):
+        start(index)
+    try:
+        asyncio.run(_supervise(make_bot(), queues, processes, start, allowed_updates))
+    finally:
+        logging.info("Остановка: закрываем очереди %d воркеров...", count)
+        for updates in queues:
+            updates.put(None)
+        deadline = time.monotonic() + STOP_TIMEOUT
+        for index, process in enumerate(processes):
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logging.warning("Воркер %d не остановился вовремя, завершаем принудительно.", index)
+                process.terminate()
+                process.join()
+
+
+async def _supervise(bot, queues, processes, start, allowed_updates):
+    """Получает апдейты и следит за воркерами, пока не придёт сигнал остановки."""
+    loop = asyncio.get_running_loop()
+    tasks = [asyncio.create_task(_poll(bot, queues, allowed_updates)),
+             asyncio.create_task(_watch(processes, start))]
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, lambda: [task.cancel() for task in tasks])
+    try:
+        await asyncio.gather(*tasks)
+    except asyncio.CancelledError:
+        pass
+    finally:
+        await bot.session.close()
+
+
+async def _poll(bot, queues, allowed_updates):
+    """Long polling: каждый апдейт уходит JSON-строкой в очередь своего воркера."""
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=POLL_TIMEOUT, allowed_updates=allowed_updates)
+        except Exception as e:
+            logging.error("Ошибка getUpdates: %s", e)
+            await asyncio.sleep(POLL_RETRY_DELAY)
+            continue
+        for update in updates:
+            queues[partition(update, len(queues))].put(update.model_dump_json(exclude_unset=True))
+            offset = update.update_id + 1
+
+
+async def _watch(processes, start):
+    """Перезапускает воркеры, которые завершились сами."""
+    while True:
+        await asyncio.sleep(RESPAWN_DELAY)
+        for index, process in enumerate(processes):
+            if not process.is_alive():
+                logging.warning("Воркер %d завершился (код %s), перезапускаем.", index, process.exitcode)
+                start(index)